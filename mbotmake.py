@@ -1,507 +1,158 @@
 #!/usr/bin/env python3
 
 import argparse
+import array
+import collections
+import concurrent.futures
+import configparser
+import functools
+import itertools
+import mmap
 import zipfile
 import json
 import sys
-import tempfile
 import copy
 import math
 import re
 import traceback
 import base64
+import contextlib
+import io
+import os
+import time
+import tracemalloc
 from os import getenv
-from enum import Enum
+from enum import Enum, IntEnum
 
 from uuid import uuid4
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEBUG = False
 
-METAJSON = '''
-{
-    "bot_type": null,
-    "bounding_box": null,
-    "chamber_temperature": null,
-    "commanded_duration_s": null,
-    "duration_s": null,
-    "extruder_temperature": null,
-    "extruder_temperatures": [null],
-    "extrusion_distance_mm": null,
-    "extrusion_distances_mm": [null],
-    "extrusion_mass_g": null,
-    "extrusion_masses_g": [null],
-    "material": "pla",
-    "materials": ["pla"],
-    "num_z_layers": null,
-    "num_z_transitions": null,
-    "platform_temperature": null,
-    "thing_id": null,
-    "tool_type": null,
-    "tool_types": [null],
-    "total_commands": null,
-    "miracle_config": {
-        "_bot": null,
-        "_extruders": [null],
-        "_materials": [
-            "pla"
-        ],
-        "doRaft": true,
-        "gaggles": {
-            "default": {
-                "adjacentFillLeakyConnections": true,
-                "adjacentFillLeakyDistanceRatio": 1.4,
-                "backlashEpsilon": 0.05,
-                "backlashFeedback": 0.9,
-                "backlashX": 0.0,
-                "backlashY": 0.09,
-                "baseInsetDistanceMultiplier": 1.0,
-                "baseLayerHeight": 0.2,
-                "baseLayerWidth": 0.5,
-                "baseNumberOfShells": 1,
-                "bedZOffset": 0,
-                "bridgeAnchorMinimumLength": 0.8,
-                "bridgeAnchorWidth": 0.8,
-                "bridgeMaximumLength": 80.0,
-                "brimsBaseWidth": 2.5,
-                "brimsModelOffset": 0.0,
-                "brimsOverlapWidth": 1.5,
-                "coarseness": 0.0001,
-                "computeVolumeLike2_1_0": false,
-                "defaultExtruder": 0,
-                "defaultSupportMaterial": 0,
-                "description": "",
-                "doBacklashCompensation": false,
-                "doBreakawaySupport": true,
-                "doBridging": true,
-                "doBrims": false,
-                "doExponentialDeceleration": true,
-                "doExternalSpurs": true,
-                "doFanCommand": true,
-                "doFanModulation": true,
-                "doFixedLayerStart": false,
-                "doFixedShellStart": true,
-                "doInternalSpurs": false,
-                "doMinfill": false,
-                "doMixedRaft": false,
-                "doMixedSupport": false,
-                "doNewPathPlanning": true,
-                "doPaddedBase": false,
-                "doRaft": true,
-                "doRateLimit": true,
-                "doSplitLongMoves": false,
-                "doSupport": true,
-                "doSupportUnderBridges": false,
-                "exponentialDecelerationMinSpeed": 0.0,
-                "exponentialDecelerationRatio": 0.375,
-                "exponentialDecelerationSegmentCount": 10,
-                "extruderProfiles": [
-                    {
-                        "defaultTemperature": 215,
-                        "extrusionProfiles": {
-                            "bridges": {
-                                "fanSpeed": 0.95,
-                                "feedrate": 40.0
-                            },
-                            "brims": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 10.0
-                            },
-                            "firstModelLayer": {
-                                "fanSpeed": 1.0,
-                                "feedrate": 30.0
-                            },
-                            "floorSurfaceFills": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 90
-                            },
-                            "infill": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 90
-                            },
-                            "insets": {
-                                "fanSpeed": 0.95,
-                                "feedrate": 90
-                            },
-                            "outlines": {
-                                "fanSpeed": 0.95,
-                                "feedrate": 40
-                            },
-                            "purge": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 100
-                            },
-                            "raft": {
-                                "fanSpeed": 0.95,
-                                "feedrate": 90.0
-                            },
-                            "raftBase": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 10.0
-                            },
-                            "roofSurfaceFills": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 90
-                            },
-                            "sparseRoofSurfaceFills": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 90
-                            },
-                            "spurs": {
-                                "fanSpeed": 0.5,
-                                "feedrate": 40
-                            }
-                        },
-                        "extrusionVolumeMultiplier": 1.0,
-                        "feedDiameter": 1.77,
-                        "idleTemperature": 190,
-                        "nozzleDiameter": 0.4,
-                        "oozeFeedstockDistance": 0.1,
-                        "preOozeFeedstockDistance": 0.1,
-                        "restartExtraDistance": 0.1,
-                        "restartRate": 30,
-                        "retractDistance": 0.5,
-                        "retractRate": 50,
-                        "toolchangeRestartDistance": 18.5,
-                        "toolchangeRestartRate": 6.0,
-                        "toolchangeRetractDistance": 19.0,
-                        "toolchangeRetractRate": 6.0
-                    }
-                ],
-                "fanDefaultSpeed": 0.95,
-                "fanLayer": 1,
-                "fanModulationThreshold": 0.5,
-                "fanModulationWindow": 0.1,
-                "fixedLayerStartX": 0,
-                "fixedLayerStartY": 0,
-                "fixedShellStartDirection": 215,
-                "floorSolidThickness": 0,
-                "floorSurfaceThickness": 0.8,
-                "floorThickness": 0.8,
-                "horizontalInset": 0,
-                "infillDensity": 0.4,
-                "infillShellSpacingMultiplier": 0.55,
-                "insetDistanceMultiplier": 1.0,
-                "layerHeight": 0.2,
-                "leakyConnectionsAdjacentDistance": 0.8,
-                "maxConnectionLength": 10.0,
-                "maxSparseFillThickness": 0.2,
-                "maxSpurWidth": 0.5,
-                "minLayerDuration": 5.0,
-                "minLayerHeight": 0.01,
-                "minRaftBaseGap": 10.0,
-                "minSpeedMultiplier": 0.3,
-                "minSpurLength": 0.34,
-                "minSpurWidth": 0.12,
-                "minThickInfillImprovement": 1.0,
-                "minimumMoveDistance": 0.01,
-                "modelFillProfiles": {
-                    "bridge": {
-                        "density": 1.0,
-                        "orientationInterval": 0,
-                        "orientationOffset": 0,
-                        "orientationRange": 360,
-                        "pattern": "bridge_fill"
-                    },
-                    "floor_surface": {
-                        "density": 1.0,
-                        "orientationInterval": 90,
-                        "orientationRange": 90,
-                        "pattern": "linear"
-                    },
-                    "roof_surface": {
-                        "density": 1.0,
-                        "orientationInterval": 90,
-                        "orientationRange": 360,
-                        "pattern": "linear"
-                    },
-                    "solid": {
-                        "density": 1.0,
-                        "orientationInterval": 90,
-                        "orientationRange": 90,
-                        "pattern": "linear"
-                    },
-                    "sparse": {
-                        "density": 0.4,
-                        "orientationInterval": 90,
-                        "orientationOffset": 0,
-                        "orientationRange": 90,
-                        "pattern": "linear"
-                    },
-                    "sparse_roof_surface": {
-                        "density": 0.4,
-                        "orientationInterval": 90,
-                        "orientationOffset": 0,
-                        "orientationRange": 90,
-                        "pattern": "linear"
-                    }
-                },
-                "numberOfBrims": 5,
-                "numberOfExtentShells": 2,
-                "numberOfInternalBrims": 5,
-                "numberOfShells": 2,
-                "numberOfSparseShells": 0,
-                "numberOfSupportShells": 0,
-                "paddedBaseOutlineOffset": -0.5,
-                "pauseHeights": [],
-                "purgeBaseRotation": 45,
-                "purgeBucketSide": 4.0,
-                "purgeWallBaseFilamentWidth": 2.0,
-                "purgeWallBasePatternLength": 10.0,
-                "purgeWallBasePatternWidth": 8.0,
-                "purgeWallModelOffset": 2.0,
-                "purgeWallPatternWidth": 2.0,
-                "purgeWallSpacing": 1.0,
-                "purgeWallWidth": 0.5,
-                "purgeWallXLength": 30,
-                "raftBaseInfillShellSpacingMultiplier": 0.1,
-                "raftBaseInsetDistanceMultiplier": 0.4,
-                "raftBaseLayers": 1,
-                "raftBaseOutset": 4,
-                "raftBaseShells": 3,
-                "raftBaseThickness": 0.3,
-                "raftBaseWidth": 2.5,
-                "raftBrimsSpacing": 1.0,
-                "raftExtraOffset": 0.0,
-                "raftFillProfiles": {
-                    "base": {
-                        "density": 0.2,
-                        "linearFillGroupDensity": 2.2,
-                        "linearFillGroupSize": 3,
-                        "orientationInterval": 0,
-                        "orientationOffset": 0,
-                        "orientationRange": 180,
-                        "pattern": "linear"
-                    },
-                    "interface": {
-                        "density": 0.5,
-                        "orientationInterval": 90,
-                        "orientationOffset": 45,
-                        "orientationRange": 360,
-                        "pattern": "linear"
-                    },
-                    "surface": {
-                        "density": 0.85,
-                        "orientationInterval": 90,
-                        "orientationOffset": 0,
-                        "orientationRange": 90,
-                        "pattern": "local_no_warp"
-                    }
-                },
-                "raftInterfaceLayers": 2,
-                "raftInterfaceShells": 0,
-                "raftInterfaceThickness": 0.27,
-                "raftInterfaceWidth": 0.4,
-                "raftInterfaceZOffset": -0.14,
-                "raftModelShellsSpacing": 0.26,
-                "raftModelSpacing": 0.33,
-                "raftSupportSpacing": 0.1,
-                "raftSurfaceInsetDistanceMultiplier": 0.8,
-                "raftSurfaceLayers": 2,
-                "raftSurfaceOutset": 4,
-                "raftSurfaceShellSpacingMultiplier": 0.7,
-                "raftSurfaceShells": 2,
-                "raftSurfaceThickness": 0.27,
-                "raftSurfaceZOffset": -0.03,
-                "rateLimitBufferSize": 100,
-                "rateLimitMinSpeed": 10,
-                "rateLimitSpeedRatio": 0.3,
-                "rateLimitSplitBias": 0,
-                "rateLimitSplitMoveDistance": 0.75,
-                "rateLimitSplitRecursionDepth": 8,
-                "rateLimitTransmissionRate": 150,
-                "roofAnchorMargin": 0.4,
-                "roofSolidThickness": 0,
-                "roofSurfaceThickness": 0.8,
-                "roofThickness": 0.8,
-                "shellsLeakyConnections": true,
-                "splitMinimumDistance": 0.4,
-                "startPosition": {
-                    "x": null,
-                    "y": null,
-                    "z": null
-                },
-                "supportAngle": 15,
-                "supportBreakawayModelOffset": -0.15,
-                "supportBreakawayModelRoofSpacing": 0.16,
-                "supportCutout": 0.1,
-                "supportCutoutExtraDistance": 0.6,
-                "supportExtraDistance": 0.5,
-                "supportFillProfiles": {
-                    "solid": {
-                        "density": 0.32,
-                        "orientationInterval": 0,
-                        "orientationOffset": 45,
-                        "orientationRange": 360,
-                        "pattern": "hilbert_fill"
-                    },
-                    "sparse": {
-                        "consistentOrder": true,
-                        "density": 0.16,
-                        "orientationInterval": 0,
-                        "orientationOffset": 45,
-                        "orientationRange": 0,
-                        "pattern": "linear"
-                    }
-                },
-                "supportInsetDistanceMultiplier": 1.0,
-                "supportInteriorExtruder": 0,
-                "supportLayerHeight": 0.2,
-                "supportLeakyConnections": true,
-                "supportModelSpacing": 0.4,
-                "supportRoofModelSpacing": 0.4,
-                "supportRoofSolidThickness": 3.0,
-                "supportShellSpacingMultiplier": 0.55,
-                "thickLayerThreshold": 0,
-                "thickLayerVolumeMultiplier": 1,
-                "travelSpeedXY": 150,
-                "travelSpeedZ": 23,
-                "useRelativeExtruderPositions": false
-            }
-        },
-        "version": "5.6.0"
-    },
-    "preferences": {
-        "default": {
-            "overrides": {
-                "defaultSupportMaterial": 0,
-                "doSupport": true,
-                "doSupportUnderBridges": false,
-                "modelFillProfiles.sparse.density": 0.4,
-                "supportAngle": 15,
-                "supportFillProfiles.sparse.density": 0.16,
-                "supportModelSpacing": 0.4,
-                "undefined": 0
-            },
-            "print_mode": "balanced"
-        }
-    },
-    "uuid": "87fe421b-427a-4657-be72-28b7a6beee72",
-    "version": "1.2.0"
-}
-'''
+# Bump when a change makes the converter produce different output
+VERSION = '1.3.0'
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROFILES_DIR = os.path.join(HERE, 'profiles')
+PRINTERCONFIGS_DIR = os.path.join(HERE, 'printerconfigs')
 
-class MachineType(Enum):
-    REPLICATOR5 = 1
-    REPLICATORPlUS = 2
-    REPLICATORMINI = 3
-    REPLICATORMINIPLUS = 4
+# Motion limits used to estimate print time, accelerations in mm/s^2, feedrates
+# and jerks in mm/s, per axis in x, y, z, e order.
+MotionLimits = collections.namedtuple('MotionLimits', ['acceleration', 'retract_acceleration', 'axis_acceleration',
+                                                       'axis_feedrate', 'axis_jerk'])
 
+# A printer or extruder of profiles/printers.json or extruders.json. names are
+# what the command line and the GUI's choice index call it, meta is merged
+# into profiles/meta.json for it. Extruders have no motion limits.
+Profile = collections.namedtuple('Profile', ['name', 'title', 'names', 'meta', 'motion_limits'])
 
-class ExtruderType(Enum):
-    SMARTEXTRUDER = 1
-    SMARTEXTRUDERPLUS = 2
-    TOUGHEXTRUDER = 3
-    EXPERIMENTALEXTRUDER = 4
 
+@functools.lru_cache(maxsize=None)
+def readPrinterConfig(filename):
+    '''A PrusaSlicer config bundle from printerconfigs/'''
+    config = configparser.ConfigParser(interpolation=None, strict=False)
+    with open(os.path.join(PRINTERCONFIGS_DIR, filename), encoding='utf-8') as configfile:
+        config.read_file(configfile)
+    return config
 
-def metaJson5th(meta):
-    '''Update botType for Replicator 5th Gen'''
-    meta['bot_type'] = "replicator_5"
-    meta['miracle_config']['_bot'] = "replicator_5"
-    meta['miracle_config']['gaggles']['default']['startPosition']['x'] = -125
-    meta['miracle_config']['gaggles']['default']['startPosition']['y'] = -99
-    meta['miracle_config']['gaggles']['default']['startPosition']['z'] = 0.2
-    return meta
 
+def printerConfigLimits(filename, section):
+    '''The MotionLimits of a printer section of a PrusaSlicer config bundle.
 
-def metaJsonPlus(meta):
-    '''Update botType for Replicator+'''
-    meta['bot_type'] = "replicator_b"
-    meta['miracle_config']['_bot'] = "replicator_b"
-    meta['miracle_config']['gaggles']['default']['startPosition']['x'] = -150
-    meta['miracle_config']['gaggles']['default']['startPosition']['y'] = -100
-    meta['miracle_config']['gaggles']['default']['startPosition']['z'] = 0.2
-    return meta
+    PrusaSlicer gives every machine limit as "normal,stealth", the normal one is used.
+    '''
+    printer = readPrinterConfig(filename)[section]
 
+    def limit(key):
+        return float(printer['machine_max_' + key].split(',')[0])
 
-def metaJsonMini(meta):
-    '''Update botType for Replicator Mini'''
-    meta['bot_type'] = "mini_4"
-    meta['miracle_config']['_bot'] = "mini_4"
-    meta['miracle_config']['gaggles']['default']['startPosition']['x'] = -59
-    meta['miracle_config']['gaggles']['default']['startPosition']['y'] = -48
-    meta['miracle_config']['gaggles']['default']['startPosition']['z'] = 1
-    return meta
+    return MotionLimits(acceleration=limit('acceleration_extruding'),
+                        retract_acceleration=limit('acceleration_retracting'),
+                        axis_acceleration=tuple(limit('acceleration_' + axis) for axis in 'xyze'),
+                        axis_feedrate=tuple(limit('feedrate_' + axis) for axis in 'xyze'),
+                        axis_jerk=tuple(limit('jerk_' + axis) for axis in 'xyze'))
 
 
-def metaJsonMiniPlus(meta):
-    '''Update botType for Replicator Mini+'''
-    meta['bot_type'] = "mini_8"
-    meta['miracle_config']['_bot'] = "mini_8"
-    meta['miracle_config']['gaggles']['default']['startPosition']['x'] = -59
-    meta['miracle_config']['gaggles']['default']['startPosition']['y'] = 37
-    meta['miracle_config']['gaggles']['default']['startPosition']['z'] = 0.2
-    return meta
+def loadProfiles(filename, directory=PROFILES_DIR):
+    '''The Profiles of a file in profiles/ by name, in the order of the file.
+
+    A printer gives its machine limits as the [file, section] of a config
+    bundle in printerconfigs/, motion_limits overrides some of them. A
+    printer without any has its duration estimated as the commanded time.
+    '''
+    with open(os.path.join(directory, filename), encoding='utf-8') as profilefile:
+        profiles = json.load(profilefile)
+    return {name: Profile(name, profile['title'], tuple(profile['names']), profile['meta'], profileLimits(profile))
+            for name, profile in profiles.items()}
 
 
-def metaJsonSmartExtruder(meta):
-    '''Updates Tool types for Smart Extruder'''
-    meta['tool_type'] = "mk12"
-    meta['tool_types'] = ["mk12"]
-    meta['miracle_config']['_extruders'] = ["mk12"]
+def profileLimits(profile):
+    '''The MotionLimits of a printer in profiles/printers.json, None if it has none'''
+    if 'printerconfig' not in profile:
+        return None
+    overrides = {key: tuple(value) if isinstance(value, list) else float(value)
+                 for key, value in profile.get('motion_limits', {}).items()}
+    return printerConfigLimits(*profile['printerconfig'])._replace(**overrides)
 
+
+def mergeMeta(meta, overrides):
+    '''Merge the fields of overrides into meta, nested objects field by field'''
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(meta.get(key), dict):
+            mergeMeta(meta[key], value)
+        else:
+            meta[key] = copy.deepcopy(value)
     return meta
 
 
-def metaJsonSmartExtruderPlus(meta):
-    '''Updates Tool types for Smart Extruder+'''
-    meta['tool_type'] = "mk13"
-    meta['tool_types'] = ["mk13"]
-    meta['miracle_config']['_extruders'] = ["mk13"]
+PRINTER_PROFILES = loadProfiles('printers.json')
+EXTRUDER_PROFILES = loadProfiles('extruders.json')
+with open(os.path.join(PROFILES_DIR, 'meta.json'), encoding='utf-8') as metafile:
+    META_TEMPLATE = json.load(metafile)
 
-    return meta
+# one member per profile, so a printer or extruder added to profiles/ needs no code
+MachineType = Enum('MachineType', list(PRINTER_PROFILES))
+ExtruderType = Enum('ExtruderType', list(EXTRUDER_PROFILES))
 
+MOTION_LIMITS = {machinetype: PRINTER_PROFILES[machinetype.name].motion_limits for machinetype in MachineType}
+# the printer of a meta.json bot_type
+BOT_TYPES = {PRINTER_PROFILES[machinetype.name].meta['bot_type']: machinetype for machinetype in MachineType}
 
-def metaJsonToughSmartExtruderPlus(meta):
-    '''Updates Tool types for Tough Smart Extruder+'''
-    meta['tool_type'] = "mk13_impla"
-    meta['tool_types'] = ["mk13_impla"]
-    meta['miracle_config']['_extruders'] = ["mk13_impla"]
 
+@functools.lru_cache(maxsize=None)
+def metaTemplate(machinetype, extrudertype):
+    '''meta.json for the printer and extruder, with the fields of the job still to be filled in'''
+    meta = copy.deepcopy(META_TEMPLATE)
+    mergeMeta(meta, PRINTER_PROFILES[machinetype.name].meta)
+    mergeMeta(meta, EXTRUDER_PROFILES[extrudertype.name].meta)
     return meta
 
 
-def metaJsonExperimentalExtruderPlus(meta):
-    '''Updates Tool types for Experimental Extruder'''
-    meta['tool_type'] = "mk13_experimental"
-    meta['tool_types'] = ["mk13_experimental"]
-    meta['miracle_config']['_extruders'] = ["mk13_experimental"]
+def generateMetajson(vardict, machinetype, extrudertype):
+    '''Build the meta.json contents for a finished toolpath'''
+    return copy.deepcopy(fillMetaTemplate(vardict, machinetype, extrudertype))
 
-    return meta
 
+def fillMetaTemplate(vardict, machinetype, extrudertype):
+    '''generateMetajson without the copy, for packaging only.
 
-def generateMetajson(temp, vardict, machinetype, extrudertype):
-    meta = json.loads(METAJSON)
-
-    match machinetype:
-        case MachineType.REPLICATOR5:
-            meta = metaJson5th(meta)
-        case MachineType.REPLICATORPlUS:
-            meta = metaJsonPlus(meta)
-        case MachineType.REPLICATORMINI:
-            meta = metaJsonMini(meta)
-        case MachineType.REPLICATORMINIPLUS:
-            meta = metaJsonMiniPlus(meta)
-
-    match extrudertype:
-        case ExtruderType.SMARTEXTRUDER:
-            meta = metaJsonSmartExtruder(meta)
-        case ExtruderType.SMARTEXTRUDERPLUS:
-            meta = metaJsonSmartExtruderPlus(meta)
-        case ExtruderType.TOUGHEXTRUDER:
-            meta = metaJsonToughSmartExtruderPlus(meta)
-        case ExtruderType.EXPERIMENTALEXTRUDER:
-            meta = metaJsonExperimentalExtruderPlus(meta)
+    Every field of the job is replaced in a shallow copy of the cached
+    template, so the printer settings nested in it are the template's own
+    and must not be modified.
+    '''
+    meta = dict(metaTemplate(machinetype, extrudertype))
 
     meta['bounding_box'] = vardict['bounding_box']
 
     meta['total_commands'] = vardict['toolpathfilelength']
 
-    meta['duration_s'] = vardict['time']
-
-    # I have no idea what this is supposed to be
-    meta['commanded_duration_s'] = vardict['time'] / 2
+    # the estimate with acceleration, the plain distance / feedrate sum is what the gcode commands
+    meta['duration_s'] = vardict['duration']
+    meta['commanded_duration_s'] = vardict['time']
 
     meta['num_z_transitions'] = vardict['z_transitions']
     meta['num_z_layers'] = vardict['z_transitions'] + 1
@@ -519,348 +170,1611 @@ def generateMetajson(temp, vardict, machinetype, extrudertype):
 
     meta['uuid'] = str(uuid4())
 
-    with open('{}/meta.json'.format(temp), 'w') as metafile:
-        json.dump(meta, metafile, indent=4)
-
-
-def generateThumbnails(filename, temp):
-    '''copied from sabesnait's rfork'''
-    tnNames = []
-    file = open(filename, 'r')
-    line = file.readline()
-    if "PrusaSlicer" not in line and "HEADER_BLOCK_START" not in line:  # only tested on Prusa Slicer
-        print(line)
-        return tnNames
-    while True:
-        line = file.readline()
-        if "thumbnail begin" in line:
-            thumbnailMeta = line.split(' ')
-            thumbnailSize = thumbnailMeta[3]
-
-            line = file.readline()
-            thumbnail_data = ""
-            while "thumbnail end" not in line and line:
-                thumbnail_data = thumbnail_data + line.strip("; \n")
-                line = file.readline()
-            decoded_data = base64.b64decode(thumbnail_data)
-            thumbnailFileName = '{}/thumbnail_' + thumbnailSize + '.png'
-            tnNames.append(thumbnailFileName)
-            with open(thumbnailFileName.format(temp), 'wb') as thumbnailFile:
-                thumbnailFile.write(decoded_data)
-        if not line:
-            break
-    file.close()
-    return tnNames
-
-
-def generateCommand(function, metadata, parameters, tags):
-    return [{'command': {'function': function,
-                         'metadata': dict(metadata),
-                         'parameters': dict(parameters),
-                         'tags': list(tags)}}]
-
-
-def computeTime(prev, current):
-    if [current['x'], current['y'], current['z']] == [prev['x'], prev['y'], prev['z']] and current['a'] != prev['a']:
-        # retraction takes time as well, add it in
-        # time = sqrt((e2-e1)^2)/feedrate
-        distance = math.dist([current['a']], [prev['a']])
-    else:
-        # get time traveled by the equasion
-        # time = sqrt((x2-x1)^2 + (y2-y1)^2 + (z2-z1)^2)/feedrate
-        distance = math.dist([current['x'], current['y'], current['z']],
-                             [prev['x'], prev['y'], prev['z']])
-    return distance / current['feedrate']
+    return meta
 
 
-def createToolpath(filename, temp):
-    corpus = open(filename).readlines()
-    processed = []
-    linenum_last = len(corpus)
-    linenum = 0
-    printline = '{0:>' + str(len(str(linenum_last))) + '}/{1} {2:>3.0f}%'
-    axis = \
-        {
+def readGcode(filename, start=0, end=None):
+    '''Lazily yield the lines of filename as bytes, from byte offset start to end.
+
+    The file is memory mapped and never decoded, so reading a huge gcode file
+    costs neither the memory of its text nor a list of all its lines.
+    '''
+    with open(filename, 'rb') as gcodefile:
+        if os.fstat(gcodefile.fileno()).st_size == 0:
+            return  # an empty file can't be mapped
+        with mmap.mmap(gcodefile.fileno(), 0, access=mmap.ACCESS_READ) as gcode:
+            gcode.seek(start)
+            if end is None or end >= len(gcode):
+                yield from iter(gcode.readline, b'')
+            else:
+                while gcode.tell() < end:
+                    yield gcode.readline()
+
+
+def isGcodePath(gcode):
+    '''Whether gcode names a file, rather than being the gcode itself'''
+    return isinstance(gcode, (str, os.PathLike))
+
+
+def gcodeSize(gcode):
+    '''Size in bytes of gcode given as a path, bytes or a binary stream, None if it can't be told'''
+    if isGcodePath(gcode):
+        return os.path.getsize(gcode)
+    if isinstance(gcode, (bytes, bytearray, memoryview)):
+        return memoryview(gcode).nbytes
+    try:
+        if gcode.seekable():
+            position = gcode.tell()
+            size = gcode.seek(0, io.SEEK_END) - position
+            gcode.seek(position)
+            return size
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def gcodeLines(gcode):
+    '''Lazily yield the lines of gcode given as a path, bytes or a binary stream, see readGcode'''
+    if isGcodePath(gcode):
+        return readGcode(gcode)
+    if isinstance(gcode, (bytes, bytearray, memoryview)):
+        gcode = io.BytesIO(gcode)
+    return iter(gcode.readline, b'')
+
+
+def hasThumbnails(firstline):
+    '''Whether a gcode file starting with firstline can carry thumbnails'''
+    return b"PrusaSlicer" in firstline or b"HEADER_BLOCK_START" in firstline  # only tested on Prusa Slicer
+
+
+def thumbnailName(beginline):
+    '''Archive name of the thumbnail started by a "thumbnail begin" line'''
+    thumbnailMeta = beginline.split(b' ')
+    thumbnailSize = thumbnailMeta[3].decode()
+    return 'thumbnail_' + thumbnailSize + '.png'
+
+
+def thumbnailLine(line):
+    '''The base64 part of a line inside a thumbnail block'''
+    return line.strip(b"; \r\n")
+
+
+def generateThumbnails(filename):
+    '''copied from sabesnait's rfork
+
+    Returns a dict mapping the archive name of every thumbnail to its PNG data.
+    createToolpath collects the same while converting, this is for when only
+    the thumbnails are wanted.
+    '''
+    thumbnails = {}
+    lines = readGcode(filename)
+    if not hasThumbnails(next(lines, b'')):
+        return thumbnails
+    for line in lines:
+        if b"thumbnail begin" in line:
+            name = thumbnailName(line)
+            # collected as a list and joined once, adding up strings is quadratic
+            thumbnail_data = []
+            for line in lines:
+                if b"thumbnail end" in line:
+                    break
+                thumbnail_data.append(thumbnailLine(line))
+            thumbnails[name] = base64.b64decode(b''.join(thumbnail_data))
+    return thumbnails
+
+
+# Moves are tagged by what they do, the tags end up in the toolpath as these labels
+class MoveTag(IntEnum):
+    TRAVEL = 0
+    INFILL = 1
+    LEAKY_TRAVEL = 2
+    RETRACT = 3
+
+
+MOVE_TAG_LABELS = ('Travel Move', 'Infill', 'Leaky Travel Move', 'Retract')
+
+
+class ToolpathStats:
+    '''Collects the meta.json statistics while the toolpath is being written
+
+    Moves are buffered in typed arrays, one per axis, and their durations,
+    z transitions, extrusion and bounding box are worked out a batch at a
+    time, with numpy when it is installed.
+
+    time is the commanded duration, distance over feedrate. With MotionLimits
+    the duration is also estimated with acceleration: junction speeds are
+    limited by the per axis jerk, the speeds along the batch by what the
+    acceleration can reach, and every move gets a trapezoidal speed profile.
+    Like the look ahead of a firmware planner, a batch starts and ends at
+    the speed the machine could stop at.
+    '''
+
+    PRINT_TAGS = (MoveTag.INFILL, MoveTag.LEAKY_TRAVEL)
+    MOVE_BATCH = 4096
+
+    def __init__(self, limits=None):
+        self.limits = limits
+        self.commands = 0
+        # Durations are summed per layer first, that way a toolpath converted in
+        # layer chunks adds up to exactly the same total as a serial conversion.
+        self.layer_times = []
+        self.layertime = 0.0
+        self.layer_durations = []
+        self.layerduration = 0.0
+        self.z_transitions = 0
+        self.extrusion_distance = None
+        self.bbox = None
+        self.lines = 0
+        # moves saved by CoalescingWriter
+        self.coalesced = 0
+        # opcode -> how often a command without a handler was skipped
+        self.ignored = collections.Counter()
+
+        # the buffered moves, and the x, y, z, a position in front of the first one
+        self.x = array.array('d')
+        self.y = array.array('d')
+        self.z = array.array('d')
+        self.a = array.array('d')
+        self.feedrate = array.array('d')
+        self.tags = array.array('B')
+        self.start = None
+
+    def addCommand(self, count=1):
+        self.commands += count
+
+    def newLayer(self):
+        # batches never straddle a layer, so chunked and serial conversions batch alike
+        self.flushMoves()
+        self.layer_times.append(self.layertime)
+        self.layertime = 0.0
+        self.layer_durations.append(self.layerduration)
+        self.layerduration = 0.0
+
+    @property
+    def time(self):
+        self.flushMoves()
+        return math.fsum([*self.layer_times, self.layertime])
+
+    @property
+    def duration(self):
+        self.flushMoves()
+        return math.fsum([*self.layer_durations, self.layerduration])
+
+    @property
+    def durations(self):
+        '''Estimated duration of every layer, the first is everything in front of the first layer marker'''
+        self.flushMoves()
+        return [*self.layer_durations, self.layerduration]
+
+    def addMove(self, prev, current, tag):
+        if self.start is None:
+            self.start = (prev['x'], prev['y'], prev['z'], prev['a'])
+        self.x.append(current['x'])
+        self.y.append(current['y'])
+        self.z.append(current['z'])
+        self.a.append(current['a'])
+        self.feedrate.append(current['feedrate'])
+        self.tags.append(tag)
+        if len(self.tags) >= self.MOVE_BATCH:
+            self.flushMoves()
+
+    def addMoves(self, start, moves):
+        '''addMove for a list of (x, y, z, a, feedrate, tag) tuples, start is the x, y, z, a in front of them'''
+        if self.start is None:
+            self.start = start
+        for column, values in zip((self.x, self.y, self.z, self.a, self.feedrate, self.tags), zip(*moves)):
+            column.extend(values)
+        if len(self.tags) >= self.MOVE_BATCH:
+            self.flushMoves()
+
+    def flushMoves(self):
+        '''Fold the buffered moves into the statistics'''
+        if not self.tags:
+            return
+        # a move at no speed never ends, and the estimate squares the feedrate, which mustn't come out 0 either
+        slowest = min(self.feedrate)
+        if not (slowest > 0.0 and slowest * slowest > 0.0):
+            raise ValueError('move at feedrate {0!r} mm/s, moves need a positive feedrate'.format(slowest))
+        if numpy is None:
+            times, z_transitions, extrusion, bbox = self.batchStats()
+            durations = times if self.limits is None else self.batchDurations()
+        else:
+            times, z_transitions, extrusion, bbox = self.batchStatsNumpy()
+            durations = times if self.limits is None else self.batchDurationsNumpy()
+
+        self.layertime += math.fsum(times)
+        self.layerduration += math.fsum(durations)
+        self.z_transitions += z_transitions
+        if self.extrusion_distance is None or extrusion > self.extrusion_distance:
+            self.extrusion_distance = extrusion
+        if bbox is not None:
+            self.mergeBoundingBox(bbox)
+
+        self.start = (self.x[-1], self.y[-1], self.z[-1], self.a[-1])
+        for column in (self.x, self.y, self.z, self.a, self.feedrate, self.tags):
+            del column[:]
+
+    def batchStats(self):
+        '''Move durations, z transitions, extrusion and bounding box of the buffered moves'''
+        px, py, pz, pa = self.start
+        times = []
+        z_transitions = 0
+        printing = []
+        for x, y, z, a, feedrate, tag in zip(self.x, self.y, self.z, self.a, self.feedrate, self.tags):
+            if x == px and y == py and z == pz:
+                # retraction takes time as well, add it in
+                times.append(abs(a - pa) / feedrate)
+            else:
+                dx, dy, dz = x - px, y - py, z - pz
+                times.append(math.sqrt(dx * dx + dy * dy + dz * dz) / feedrate)
+            if z > pz:
+                z_transitions += 1
+            if tag == MoveTag.INFILL or tag == MoveTag.LEAKY_TRAVEL:
+                printing.append((x, y, z))
+            px, py, pz, pa = x, y, z, a
+
+        bbox = None
+        if printing:
+            xs, ys, zs = zip(*printing)
+            bbox = {'x_max': max(xs), 'x_min': min(xs),
+                    'y_max': max(ys), 'y_min': min(ys),
+                    'z_max': max(zs), 'z_min': min(zs)}
+        return times, z_transitions, max(self.a), bbox
+
+    def batchStatsNumpy(self):
+        '''batchStats, vectorized'''
+        columns = [numpy.frombuffer(column, dtype=numpy.float64) for column in (self.x, self.y, self.z, self.a)]
+        x, y, z, a = columns
+        px, py, pz, pa = (numpy.concatenate(([start], column[:-1])) for start, column in zip(self.start, columns))
+        feedrate = numpy.frombuffer(self.feedrate, dtype=numpy.float64)
+        tags = numpy.frombuffer(self.tags, dtype=numpy.uint8)
+
+        dx, dy, dz = x - px, y - py, z - pz
+        distance = numpy.where((dx == 0) & (dy == 0) & (dz == 0), numpy.abs(a - pa), numpy.sqrt(dx * dx + dy * dy + dz * dz))
+        times = (distance / feedrate).tolist()
+
+        bbox = None
+        printing = (tags == MoveTag.INFILL) | (tags == MoveTag.LEAKY_TRAVEL)
+        if printing.any():
+            x, y, z = x[printing], y[printing], z[printing]
+            bbox = {'x_max': float(x.max()), 'x_min': float(x.min()),
+                    'y_max': float(y.max()), 'y_min': float(y.min()),
+                    'z_max': float(z.max()), 'z_min': float(z.min())}
+        return times, int(numpy.count_nonzero(dz > 0)), float(a.max()), bbox
+
+    def batchDurations(self):
+        '''Estimated durations of the buffered moves'''
+        limits = self.limits
+        axes = tuple(zip(limits.axis_acceleration, limits.axis_feedrate))
+        inf = float('inf')
+
+        # length, direction, top speed and acceleration of every move that goes anywhere
+        lengths, directions, speeds, accelerations = [], [], [], []
+        px, py, pz, pa = self.start
+        for x, y, z, a, feedrate in zip(self.x, self.y, self.z, self.a, self.feedrate):
+            dx, dy, dz, de = x - px, y - py, z - pz, a - pa
+            px, py, pz, pa = x, y, z, a
+            length = math.sqrt(dx * dx + dy * dy + dz * dz)
+            if length == 0.0:
+                if de == 0.0:
+                    continue
+                length = abs(de)
+                direction = (dx / length, dy / length, dz / length, de / length)
+                acceleration = limits.retract_acceleration
+            else:
+                direction = (dx / length, dy / length, dz / length, 0.0)
+                acceleration = limits.acceleration
+            speed = feedrate
+            for component, (axisacceleration, axisfeedrate) in zip(direction, axes):
+                if component:
+                    acceleration = min(acceleration, axisacceleration / abs(component))
+                    speed = min(speed, axisfeedrate / abs(component))
+            lengths.append(length)
+            directions.append(direction)
+            speeds.append(speed)
+            accelerations.append(acceleration)
+        if not lengths:
+            return []
+
+        # squared speed limit at every junction, at rest in front of the first and after the last move
+        rest = (0.0, 0.0, 0.0, 0.0)
+        caps = []
+        for before, after, speed in zip([rest] + directions, directions + [rest],
+                                        map(min, [inf] + speeds, speeds + [inf])):
+            for jerk, b, c in zip(limits.axis_jerk, before, after):
+                change = abs(c - b)
+                if change:
+                    speed = min(speed, jerk / change)
+            caps.append(speed * speed)
+
+        # forward and backward pass, speed squared grows by at most 2 a l over a move
+        reach = [2.0 * acceleration * length for acceleration, length in zip(accelerations, lengths)]
+        reached = list(itertools.accumulate(reach, initial=0.0))
+        forward = []
+        lowest = inf
+        for cap, distance in zip(caps, reached):
+            lowest = min(lowest, cap - distance)
+            forward.append(min(distance + lowest, cap))
+        junctions = []
+        lowest = inf
+        for cap, distance in zip(reversed(forward), reversed(reached)):
+            lowest = min(lowest, cap + distance)
+            junctions.append(max(min(lowest - distance, cap), 0.0))
+        junctions.reverse()
+
+        durations = []
+        for length, speed, acceleration, distance, entry, exit in zip(lengths, speeds, accelerations, reach,
+                                                                      junctions, junctions[1:]):
+            top = min(speed * speed, (distance + entry + exit) * 0.5)
+            cruise = max(length - (2.0 * top - entry - exit) / (2.0 * acceleration), 0.0)
+            top = math.sqrt(top)
+            durations.append((2.0 * top - math.sqrt(entry) - math.sqrt(exit)) / acceleration + cruise / top)
+        return durations
+
+    def batchDurationsNumpy(self):
+        '''batchDurations, vectorized'''
+        limits = self.limits
+        columns = [numpy.frombuffer(column, dtype=numpy.float64) for column in (self.x, self.y, self.z, self.a)]
+        dx, dy, dz, de = (numpy.diff(column, prepend=start) for start, column in zip(self.start, columns))
+        speeds = numpy.frombuffer(self.feedrate, dtype=numpy.float64)
+
+        lengths = numpy.sqrt(dx * dx + dy * dy + dz * dz)
+        retracts = lengths == 0.0
+        lengths = numpy.where(retracts, numpy.abs(de), lengths)
+        moving = lengths != 0.0
+        if not moving.any():
+            return []
+        lengths, retracts, speeds = lengths[moving], retracts[moving], speeds[moving]
+        directions = numpy.stack([dx[moving], dy[moving], dz[moving], numpy.where(retracts, de[moving], 0.0)], axis=1)
+        directions /= lengths[:, None]
+
+        accelerations = numpy.where(retracts, limits.retract_acceleration, limits.acceleration)
+        with numpy.errstate(divide='ignore'):
+            components = numpy.abs(directions)
+            for axis, (axisacceleration, axisfeedrate) in enumerate(zip(limits.axis_acceleration, limits.axis_feedrate)):
+                accelerations = numpy.minimum(accelerations, axisacceleration / components[:, axis])
+                speeds = numpy.minimum(speeds, axisfeedrate / components[:, axis])
+
+            rest = numpy.zeros((1, 4))
+            changes = numpy.abs(numpy.diff(numpy.concatenate([rest, directions, rest]), axis=0))
+            unbounded = numpy.array([numpy.inf])
+            caps = numpy.minimum(numpy.concatenate([unbounded, speeds]), numpy.concatenate([speeds, unbounded]))
+            for axis, jerk in enumerate(limits.axis_jerk):
+                caps = numpy.minimum(caps, jerk / changes[:, axis])
+        caps = caps * caps
+
+        reach = 2.0 * accelerations * lengths
+        reached = numpy.concatenate([[0.0], numpy.cumsum(reach)])
+        forward = numpy.minimum(reached + numpy.minimum.accumulate(caps - reached), caps)
+        junctions = numpy.minimum.accumulate((forward + reached)[::-1])[::-1] - reached
+        junctions = numpy.maximum(numpy.minimum(junctions, forward), 0.0)
+
+        entry, exit = junctions[:-1], junctions[1:]
+        top = numpy.minimum(speeds * speeds, (reach + entry + exit) * 0.5)
+        cruise = numpy.maximum(lengths - (2.0 * top - entry - exit) / (2.0 * accelerations), 0.0)
+        top = numpy.sqrt(top)
+        return ((2.0 * top - numpy.sqrt(entry) - numpy.sqrt(exit)) / accelerations + cruise / top).tolist()
+
+    def mergeBoundingBox(self, bbox):
+        if self.bbox is None:
+            self.bbox = dict(bbox)
+            return
+        for key, value in bbox.items():
+            if key.endswith('_max') and value > self.bbox[key]:
+                self.bbox[key] = value
+            elif key.endswith('_min') and value < self.bbox[key]:
+                self.bbox[key] = value
+
+    def merge(self, other):
+        '''Append the statistics of the toolpath chunk that directly follows this one'''
+        self.flushMoves()
+        other.flushMoves()
+        self.commands += other.commands
+        self.lines += other.lines
+        self.coalesced += other.coalesced
+        self.ignored.update(other.ignored)
+        if other.layer_times:
+            self.layer_times.append(self.layertime + other.layer_times[0])
+            self.layer_times.extend(other.layer_times[1:])
+            self.layertime = other.layertime
+            self.layer_durations.append(self.layerduration + other.layer_durations[0])
+            self.layer_durations.extend(other.layer_durations[1:])
+            self.layerduration = other.layerduration
+        else:
+            self.layertime += other.layertime
+            self.layerduration += other.layerduration
+        self.z_transitions += other.z_transitions
+        if other.extrusion_distance is not None:
+            if self.extrusion_distance is None or other.extrusion_distance > self.extrusion_distance:
+                self.extrusion_distance = other.extrusion_distance
+        if other.bbox is not None:
+            self.mergeBoundingBox(other.bbox)
+
+    def validate(self, printersettings):
+        '''Sanity check the finished toolpath before it gets packaged'''
+        self.flushMoves()
+        assert printersettings['extruder_temperature'] > 0, 'no extruder temperature set'
+        assert self.bbox is not None, 'toolpath contains no printing moves'
+        bbox = self.bbox
+
+        # Make sure bounding box is centered near the origin in X/Y and at the bottom of Z.
+        xrel = (bbox['x_max'] + bbox['x_min']) / (bbox['x_max'] - bbox['x_min'])
+        yrel = (bbox['y_max'] + bbox['y_min']) / (bbox['y_max'] - bbox['y_min'])
+        assert -0.15 < xrel < 0.15, xrel
+        assert -0.15 < yrel < 0.15, yrel
+        assert 0 < bbox['z_min'] < 0.5, bbox['z_min']
+
+    def settings(self):
+        self.flushMoves()
+        return {'time': self.time,
+                'duration': self.duration,
+                'layer_durations': self.durations,
+                'toolpathfilelength': self.commands,
+                'coalesced': self.coalesced,
+                'z_transitions': self.z_transitions,
+                'extrusion_distance': self.extrusion_distance,
+                'bounding_box': self.bbox}
+
+
+TOOLPATH_HEADER = [
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Layer Section 0 (0)"},"tags":[]}}',
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Material 0"},"tags":[]}}',
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Lower Position  0"},"tags":[]}}',
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Upper Position  0.3"},"tags":[]}}',
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Thickness       0.3"},"tags":[]}}',
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Width           2.5"},"tags":[]}}',
+    '{"command" : {"function":"move","metadata":{"relative":{"a":false,"x":false,"y":false,"z":false}},"parameters":{"a":0.0,"feedrate":23.0,"x":-50.0,"y":-50.0,"z":0.30},"tags":["Travel Move"]}}']
+TOOLPATH_FOOTER = \
+    '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"End of print"},"tags":[]}}'
+
+# Pieces of the records written for every command, identical to what json.dumps
+# makes of a {'command': {'function': ..., 'metadata': ..., 'parameters': ..., 'tags': ...}} dict.
+MOVE_PREFIX = '{"command": {"function": "move", ' \
+              '"metadata": {"relative": {"a": false, "x": false, "y": false, "z": false}}, ' \
+              '"parameters": {"a": '
+MOVE_SUFFIX = tuple('}, "tags": [' + json.dumps(label) + ']}},\n' for label in MOVE_TAG_LABELS)
+FAN_DUTY_PREFIX = '{"command": {"function": "fan_duty", "metadata": {}, "parameters": {"index": '
+TOGGLE_FAN_PREFIX = '{"command": {"function": "toggle_fan", "metadata": {}, "parameters": {"index": '
+TOOLHEAD_TEMPERATURE_PREFIX = '{"command": {"function": "set_toolhead_temperature", "metadata": {}, "parameters": {'
+COMMENT_PREFIX = '{"command": {"function": "comment", "metadata": {}, "parameters": {"comment": '
+RECORD_SUFFIX = '}, "tags": []}},\n'
+
+# Decimals written for every move parameter: micrometres for x, y and z, the
+# extrusion as precise as slicers write it and hundredths of mm/s for feedrate.
+# Shortest round tripping floats (precision None) carry a lot of digit noise,
+# 0.3 + -0.05 comes out as 0.24999999999999997.
+DEFAULT_PRECISION = {'a': 5, 'feedrate': 2, 'x': 3, 'y': 3, 'z': 3}
+
+
+class ToolpathWriter:
+    '''Serializes toolpath commands to toolpathfile and counts them in stats
+
+    The records are assembled from the fragments above rather than going
+    through a dict and json.dumps, moves make up almost all of a toolpath so
+    this is where conversion spends most of its time.
+    '''
+
+    BUFFERED_RECORDS = 1024
+    FORMAT_CACHE_SIZE = 65536
+
+    def __init__(self, toolpathfile, stats, precision=None):
+        self.toolpathfile = toolpathfile
+        self.stats = stats
+        self.buffer = []
+        # per parameter the format spec and the values already formatted with it,
+        # feedrate, z and most x and y values repeat so this saves most of the formatting
+        self.precision = None
+        if precision is not None:
+            self.precision = {key: '.{}f'.format(digits) for key, digits in precision.items()}
+            self.formatted = ({}, {}, {}, {}, {})
+
+    def begin(self):
+        self.toolpathfile.write('[\n')
+        for line in TOOLPATH_HEADER:
+            self.toolpathfile.write(line + ',\n')
+        self.stats.addCommand(len(TOOLPATH_HEADER))
+
+    def end(self):
+        self.flush()
+        self.toolpathfile.write(TOOLPATH_FOOTER + '\n]')
+        self.stats.addCommand()
+
+    def flush(self):
+        self.toolpathfile.write(''.join(self.buffer))
+        self.buffer.clear()
+
+    def write(self, record):
+        buffer = self.buffer
+        buffer.append(record)
+        self.stats.commands += 1
+        if len(buffer) >= self.BUFFERED_RECORDS:
+            self.flush()
+
+    def newLayer(self):
+        self.stats.newLayer()
+
+    def fixed(self, key, formatted, value):
+        '''value with the precision of key and without trailing zeros, remembered in formatted'''
+        text = format(value, self.precision[key])
+        if '.' in text:
+            text = text.rstrip('0')
+            if text.endswith('.'):
+                text += '0'
+        if len(formatted) >= self.FORMAT_CACHE_SIZE:
+            formatted.clear()
+        formatted[value] = text
+        return text
+
+    def move(self, prev, axis, tag):
+        '''Write the move from prev to axis'''
+        if self.precision is not None:
+            a, f, x, y, z = self.formatted
+            parameters = f'{a.get(axis["a"]) or self.fixed("a", a, axis["a"])}, ' \
+                         f'"feedrate": {f.get(axis["feedrate"]) or self.fixed("feedrate", f, axis["feedrate"])}, ' \
+                         f'"x": {x.get(axis["x"]) or self.fixed("x", x, axis["x"])}, ' \
+                         f'"y": {y.get(axis["y"]) or self.fixed("y", y, axis["y"])}, ' \
+                         f'"z": {z.get(axis["z"]) or self.fixed("z", z, axis["z"])}'
+        else:
+            parameters = f'{axis["a"]!r}, "feedrate": {axis["feedrate"]!r}, ' \
+                         f'"x": {axis["x"]!r}, "y": {axis["y"]!r}, "z": {axis["z"]!r}'
+        # the keys contain no 'n', so this only trips on nan and inf which aren't valid JSON
+        if 'n' in parameters:
+            raise ValueError('Out of range float values are not JSON compliant: ' + parameters)
+        self.write(MOVE_PREFIX + parameters + MOVE_SUFFIX[tag])
+        self.stats.addMove(prev, axis, tag)
+
+    def fanDuty(self, fanduty):
+        self.write(f'{FAN_DUTY_PREFIX}{fanduty["index"]!r}, "value": {fanduty["value"]!r}{RECORD_SUFFIX}')
+
+    def toggleFan(self, fanstatus):
+        value = 'true' if fanstatus['value'] else 'false'
+        self.write(f'{TOGGLE_FAN_PREFIX}{fanstatus["index"]!r}, "value": {value}{RECORD_SUFFIX}')
+
+    def toolheadTemperature(self, temperature, index=None):
+        if index is None:
+            self.write(f'{TOOLHEAD_TEMPERATURE_PREFIX}"temperature": {temperature!r}{RECORD_SUFFIX}')
+        else:
+            self.write(f'{TOOLHEAD_TEMPERATURE_PREFIX}"index": {index!r}, "temperature": {temperature!r}{RECORD_SUFFIX}')
+
+    def comment(self, comment):
+        self.write(COMMENT_PREFIX + json.dumps(comment) + RECORD_SUFFIX)
+
+
+class CoalescingWriter(ToolpathWriter):
+    '''A ToolpathWriter that merges runs of collinear moves into one move
+
+    Consecutive moves are merged while they have the same tag and feedrate,
+    every point passed on the way stays within tolerance mm of the merged
+    move and the extrusion per mm of each part stays within
+    EXTRUSION_TOLERANCE of the first. The run held back is written before
+    anything else, and at every layer, so chunked conversions merge exactly
+    like serial ones. The number of moves saved is counted in stats.coalesced.
+    '''
+
+    EXTRUSION_TOLERANCE = 0.01
+    MAX_RUN = 64
+
+    def __init__(self, toolpathfile, stats, tolerance, precision=None):
+        super().__init__(toolpathfile, stats, precision)
+        self.tolerance = tolerance
+        # start of the run held back, its end and the points it passes through
+        self.runstart = None
+        self.runend = None
+        self.runtag = None
+        self.runpoints = []
+        self.runextrusion = None
+
+    def emitRun(self):
+        if self.runstart is None:
+            return
+        start, end, tag = self.runstart, self.runend, self.runtag
+        self.runstart = None
+        self.stats.coalesced += len(self.runpoints)
+        self.runpoints = []
+        ToolpathWriter.move(self, start, end, tag)
+
+    def extends(self, axis, tag):
+        '''Whether the move from the run's end to axis can be merged into the run'''
+        start, end = self.runstart, self.runend
+        if tag != self.runtag or axis['feedrate'] != end['feedrate'] or len(self.runpoints) >= self.MAX_RUN:
+            return False
+        length = math.dist((end['x'], end['y'], end['z']), (axis['x'], axis['y'], axis['z']))
+        if length == 0.0 or abs((axis['a'] - end['a']) / length - self.runextrusion) > \
+                self.EXTRUSION_TOLERANCE * abs(self.runextrusion):
+            return False
+
+        sx, sy, sz = start['x'], start['y'], start['z']
+        ex, ey, ez = axis['x'] - sx, axis['y'] - sy, axis['z'] - sz
+        span = ex * ex + ey * ey + ez * ez
+        if span == 0.0:
+            return False
+        for point in itertools.chain(self.runpoints, [end]):
+            px, py, pz = point['x'] - sx, point['y'] - sy, point['z'] - sz
+            along = (px * ex + py * ey + pz * ez) / span
+            if not 0.0 < along < 1.0:
+                return False
+            if math.dist((px, py, pz), (along * ex, along * ey, along * ez)) > self.tolerance:
+                return False
+        return True
+
+    def move(self, prev, axis, tag):
+        if self.runstart is not None and self.extends(axis, tag):
+            self.runpoints.append(self.runend)
+            self.runend = axis.copy()
+            return
+        self.emitRun()
+        length = math.dist((prev['x'], prev['y'], prev['z']), (axis['x'], axis['y'], axis['z']))
+        if length == 0.0:
+            # retracts and the like have no direction to continue in
+            ToolpathWriter.move(self, prev, axis, tag)
+            return
+        self.runstart = prev.copy()
+        self.runend = axis.copy()
+        self.runtag = tag
+        self.runextrusion = (axis['a'] - prev['a']) / length
+
+    def write(self, record):
+        self.emitRun()
+        super().write(record)
+
+    def newLayer(self):
+        self.emitRun()
+        super().newLayer()
+
+    def flush(self):
+        self.emitRun()
+        super().flush()
+
+
+def newWriter(toolpathfile, stats, coalesce=None, precision=None):
+    '''A ToolpathWriter, merging collinear moves within coalesce mm when it is given'''
+    if coalesce:
+        return CoalescingWriter(toolpathfile, stats, coalesce, precision)
+    return ToolpathWriter(toolpathfile, stats, precision)
+
+
+# The common "G1 X.. Y.. E.." family of moves, words in the order slicers write them.
+# Anything that doesn't fit goes through the generic word parser instead.
+FAST_MOVE = re.compile(rb'G([01])(?: F([^\s;]+))?(?: X([^\s;]+))?(?: Y([^\s;]+))?(?: Z([^\s;]+))?(?: E([^\s;]+))?'
+                       rb'(?: F([^\s;]+))?[ \t\r]*(?:;|$)')
+MOVE_OPCODES = {b'0': 'G0', b'1': 'G1'}
+
+
+def newToolpathState():
+    '''Machine state at the start of a print'''
+    return {
+        'axis': {
             'a': 0.0,
             'feedrate': 23.0,
             'x': -10.3,
             'y': -0.25,
             'z': 0.3
-        }
-    tempmetadata = \
-        {
+        },
+        'tempmetadata': {
             'index': -1,
             'temperature': 0
-        }
-    fanstatus = \
-        {
+        },
+        'fanstatus': {
             'index': 0,
             'value': False
-        }
-    fanduty = \
-        {
+        },
+        'fanduty': {
             'index': 0,
             'value': 0.0
-        }
-    printersettings = \
-        {
+        },
+        'printersettings': {
             'bedtemp': 0,
             'heatbed': False,
-            'time': 0.0,
-            'toolpathfilelength': 0,
-            'z_transitions': 0,
-            'extruder_temperature': 0
-        }
-    printeroffset = \
-        {
+            'extruder_temperature': 0,
+            # nonzero temperatures after the first, meta.json only has the first
+            'extra_temperatures': 0
+        },
+        'printeroffset': {
             'a': 0.0,
             'x': 0.0,
             'y': 0.0,
             'z': -0.05
         }
-    print('lines processed:')
-    print(printline.format(0, linenum_last, 0.0), end='')
-    """
-    Quick reference:
-    G0/G1 is move
-    M104 is set_toolhead_temperature
-    M140 sets bed temp
-    M106 is fan_duty (sets fan)
-    M107 is toggle_fan (off)
-    M141 sets chamber temperature
-    G90 toggles absolute positioning
-    G91 toggles relative positioning
-    """
-    ignoring = False
-    for linenum, line in enumerate(corpus, start=1):
+    }
+
+
+def finishMove(state, opcode, prev):
+    '''Tag and write out the move from prev to the current axis position'''
+    axis = state['axis']
+    if opcode == 'G0':
+        tag = MoveTag.TRAVEL
+    elif prev['a'] < axis['a']:
+        tag = MoveTag.INFILL
+    elif prev['a'] == axis['a']:
+        tag = MoveTag.LEAKY_TRAVEL
+    else:
+        tag = MoveTag.RETRACT
+
+    state['writer'].move(prev, axis, tag)
+
+
+def gcodeMove(state, words):
+    '''G0/G1 is move'''
+    axis = state['axis']
+    if len(words) == 2 and words[1][0] == 'F':
+        axis['feedrate'] = float(words[1][1:]) / 60.0
+        return
+
+    printeroffset = state['printeroffset']
+    prev = axis.copy()
+    for ax in words[1:]:
+        if ax[0] == 'E':
+            axis['a'] = printeroffset['a'] + float(ax[1:])
+        elif ax[0] == 'X':
+            axis['x'] = printeroffset['x'] + float(ax[1:])
+        elif ax[0] == 'Y':
+            axis['y'] = printeroffset['y'] + float(ax[1:])
+        elif ax[0] == 'Z':
+            axis['z'] = printeroffset['z'] + float(ax[1:])
+        elif ax[0] == 'F':
+            axis['feedrate'] = float(ax[1:]) / 60.0
+    finishMove(state, words[0], prev)
+
+
+# How far the moves an arc is split into may be off the arc, in mm
+ARC_TOLERANCE = 0.01
+
+
+def arcPoints(start, end, center, clockwise, tolerance):
+    '''Points along an arc in the XY plane, no chord more than tolerance off the arc.
+
+    start and end are x, y, z, a tuples, z and a change evenly along the arc.
+    The last point is end itself.
+    '''
+    sx, sy, sz, sa = start
+    ex, ey, ez, ea = end
+    cx, cy = center
+    radius = math.hypot(sx - cx, sy - cy)
+    startangle = math.atan2(sy - cy, sx - cx)
+    endangle = math.atan2(ey - cy, ex - cx)
+    if clockwise:
+        sweep = (startangle - endangle) % math.tau
+    else:
+        sweep = (endangle - startangle) % math.tau
+    if sweep == 0.0 and (sx, sy) == (ex, ey):
+        sweep = math.tau  # a full circle
 
-        if (linenum % 100) == 0 or linenum == linenum_last:
-            if ignoring:
-                print('\n')
-            ignoring = False
-            print('\x1b[2K\r' + printline.format(linenum, linenum_last, linenum / linenum_last * 100.0), end='')
+    # the sagitta of a chord spanning angle t is r (1 - cos(t / 2))
+    if radius > tolerance:
+        segments = max(1, math.ceil(sweep / (2.0 * math.acos(1.0 - tolerance / radius))))
+    else:
+        segments = 1
+    step = (-sweep if clockwise else sweep) / segments
+    for segment in range(1, segments):
+        angle = startangle + step * segment
+        fraction = segment / segments
+        yield (cx + radius * math.cos(angle), cy + radius * math.sin(angle),
+               sz + (ez - sz) * fraction, sa + (ea - sa) * fraction)
+    yield end
+
+
+def arcCenter(start, end, radius, clockwise):
+    '''Center of the arc of the given radius, negative for the long way round'''
+    sx, sy = start
+    ex, ey = end
+    chord = math.hypot(ex - sx, ey - sy)
+    if chord == 0.0:
+        return None
+    height = math.sqrt(max(radius * radius - chord * chord / 4.0, 0.0))
+    # the center is on the right of the chord for clockwise arcs
+    if clockwise == (radius > 0):
+        height = -height
+    return ((sx + ex) / 2.0 - height * (ey - sy) / chord,
+            (sy + ey) / 2.0 + height * (ex - sx) / chord)
+
+
+def gcodeArc(state, words):
+    '''G2/G3 is a clockwise/counterclockwise arc, written as the moves along it'''
+    axis = state['axis']
+    printeroffset = state['printeroffset']
+    target = axis.copy()
+    offset = {}
+    for ax in words[1:]:
+        if ax[0] == 'E':
+            target['a'] = printeroffset['a'] + float(ax[1:])
+        elif ax[0] == 'X':
+            target['x'] = printeroffset['x'] + float(ax[1:])
+        elif ax[0] == 'Y':
+            target['y'] = printeroffset['y'] + float(ax[1:])
+        elif ax[0] == 'Z':
+            target['z'] = printeroffset['z'] + float(ax[1:])
+        elif ax[0] == 'F':
+            target['feedrate'] = float(ax[1:]) / 60.0
+        elif ax[0] in 'IJR':
+            offset[ax[0]] = float(ax[1:])
+
+    clockwise = words[0] == 'G2'
+    if 'I' in offset or 'J' in offset:
+        center = (axis['x'] + offset.get('I', 0.0), axis['y'] + offset.get('J', 0.0))
+    elif 'R' in offset:
+        center = arcCenter((axis['x'], axis['y']), (target['x'], target['y']), offset['R'], clockwise)
+    else:
+        center = None
+    if center is None:
+        # nothing to go round, move straight there
+        prev = axis.copy()
+        axis.update(target)
+        finishMove(state, 'G1', prev)
+        return
+
+    axis['feedrate'] = target['feedrate']
+    points = arcPoints((axis['x'], axis['y'], axis['z'], axis['a']),
+                       (target['x'], target['y'], target['z'], target['a']),
+                       center, clockwise, state.get('arc_tolerance', ARC_TOLERANCE))
+    for x, y, z, a in points:
+        prev = axis.copy()
+        axis['x'], axis['y'], axis['z'], axis['a'] = x, y, z, a
+        finishMove(state, 'G1', prev)
+
+
+def gcodeSetPosition(state, words):
+    '''G92 sets the current position'''
+    axis = state['axis']
+    printeroffset = state['printeroffset']
+    for ax in words[1:]:
+        if ax[0] == 'E':
+            printeroffset['a'] = axis['a'] + float(ax[1:])
+        elif ax[0] == 'X':
+            printeroffset['x'] = axis['x'] + float(ax[1:])
+        elif ax[0] == 'Y':
+            printeroffset['y'] = axis['y'] + float(ax[1:])
+        elif ax[0] == 'Z':
+            printeroffset['z'] = axis['z'] + float(ax[1:])
+
+
+def gcodeToolheadTemperature(state, words):
+    '''M104 is set_toolhead_temperature'''
+    tempmetadata = state['tempmetadata']
+    printersettings = state['printersettings']
+    for ax in words[1:]:
+        if ax[0] == 'T':
+            tempmetadata['index'] = int(ax[1:])
+        elif ax[0] == 'S':
+            tempmetadata['temperature'] = int(ax[1:])
+            if tempmetadata['temperature'] != 0:
+                if printersettings['extruder_temperature'] == 0:
+                    printersettings['extruder_temperature'] = tempmetadata['temperature']
+                else:
+                    printersettings['extra_temperatures'] += 1
+    if tempmetadata['index'] != -1:
+        state['writer'].toolheadTemperature(tempmetadata['temperature'], tempmetadata['index'])
+        if printersettings['tool{}temp'.format(tempmetadata['index'])] == 0:
+            printersettings['tool{}temp'.format(tempmetadata['index'])] = tempmetadata['temperature']
+    else:  # there is only one extruder
+        state['writer'].toolheadTemperature(tempmetadata['temperature'])
+        printersettings['tool0temp'] = tempmetadata['temperature']
+
+
+def gcodeFanDuty(state, words):
+    '''M106 is fan_duty (sets fan)'''
+    fanduty = state['fanduty']
+    fanstatus = state['fanstatus']
+    for ax in words[1:]:
+        if ax[0] == 'P':
+            fanduty['index'] = int(ax[1:])
+            fanstatus['index'] = int(ax[1:])
+        elif ax[0] == 'S':
+            fanduty['value'] = float(ax[1:]) / 255
+    if not fanstatus['value']:
+        fanstatus['value'] = True
+        state['writer'].toggleFan(fanstatus)
+    state['writer'].fanDuty(fanduty)
+
+
+def gcodeFanOff(state, words):
+    '''M107 is toggle_fan (off)'''
+    state['fanstatus']['value'] = False
+    state['writer'].toggleFan(state['fanstatus'])
+
+
+def gcodeBedTemperature(state, words):
+    '''M140 sets bed temp'''
+    state['printersettings']['bedtemp'] = int(words[1][1:])
+    state['printersettings']['heatbed'] = True
+
+
+def gcodeNothing(state, words):
+    '''Understood, but has no toolpath equivalent'''
+    pass
+
+
+# Quick reference:
+# G0/G1 is move
+# G2/G3 is an arc, split up into moves
+# M104 is set_toolhead_temperature
+# M140 sets bed temp
+# M106 is fan_duty (sets fan)
+# M107 is toggle_fan (off)
+# M141 sets chamber temperature
+# G90 toggles absolute positioning
+# G91 toggles relative positioning
+GCODE_HANDLERS = {
+    'G0': gcodeMove,
+    'G1': gcodeMove,
+    'G2': gcodeArc,
+    'G3': gcodeArc,
+    'G92': gcodeSetPosition,
+    'M82': gcodeNothing,  # E absolute
+    'M104': gcodeToolheadTemperature,
+    'M105': gcodeNothing,  # Report temp
+    'M106': gcodeFanDuty,
+    'M107': gcodeFanOff,
+    'M109': gcodeNothing,  # Wait for hotend temp
+    'M140': gcodeBedTemperature,
+}
 
-        if line.startswith(';LAYER:'):
-            sec = int(line.split(':', 1)[1])
-            # We add the first section manually
-            if sec > 0:
-                processed += generateCommand('comment', {}, {'comment': f'Layer Section {sec} ({sec})'}, [])
-                processed += generateCommand('comment', {}, {'comment': 'Material 0'}, [])
 
-        line = line.split(';', 1)[0]
-        line = [part for part in line.strip().split(' ') if part != '']
+# Progress
+#
+# Conversion progress goes to a callback taking a Progress. The stages are
+# 'converting', 'checking', 'packaging' and 'done'; the remaining time is
+# extrapolated from the rate the gcode has been read at so far. bytes_total
+# is None for gcode streamed from somewhere its size isn't known.
 
-        if not line:
-            continue
+Progress = collections.namedtuple('Progress', ['stage', 'bytes_done', 'bytes_total', 'eta_s', 'lines'])
+
+
+class ConversionCancelled(Exception):
+    '''Raised from a progress callback to stop the conversion'''
+
+# The clock is only looked at every PROGRESS_LINES lines, reports are at least
+# PROGRESS_INTERVAL seconds apart
+PROGRESS_LINES = 256
+PROGRESS_INTERVAL = 0.2
+
+
+class ProgressReporter:
+    '''Throttles the progress of one stage on its way to a callback'''
+
+    def __init__(self, callback, stage, total, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.stage = stage
+        self.total = total
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = None
+        self.done = 0
+
+    def __call__(self, lines, done, force=False):
+        self.done = done
+        now = time.monotonic()
+        if not force and self.last is not None and now - self.last < self.interval:
+            return
+        self.last = now
+        eta = None
+        if self.total is not None:
+            done = min(done, self.total)
+            eta = (now - self.start) * (self.total - done) / done if done else None
+        self.callback(Progress(self.stage, done, self.total, eta, lines))
+
+    def finish(self, lines=None):
+        self(lines, self.done if self.total is None else self.total, force=True)
 
-        if line[0] in ['G0', 'G1']:
-
-            if len(line) == 2 and line[1][0] == 'F':
-                axis['feedrate'] = float(line[1][1:]) / 60.0
-
-            else:  # Normal move
-                prev = axis.copy()
-                for ax in line[1:]:
-                    if ax[0] == 'E':
-                        axis['a'] = printeroffset['a'] + float(ax[1:])
-                    elif ax[0] == 'X':
-                        axis['x'] = printeroffset['x'] + float(ax[1:])
-                    elif ax[0] == 'Y':
-                        axis['y'] = printeroffset['y'] + float(ax[1:])
-                    elif ax[0] == 'Z':
-                        axis['z'] = printeroffset['z'] + float(ax[1:])
-                    elif ax[0] == 'F':
-                        axis['feedrate'] = float(ax[1:]) / 60.0
-
-                if line[0] == 'G0':
-                    tag = 'Travel Move'
+
+class ConsoleProgress:
+    '''The default progress callback, printing to stdout.
+
+    On a terminal the line of the current stage is updated in place, otherwise
+    a line is printed per stage and for every tenth of the input.
+    '''
+
+    def __init__(self, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.tty = self.stream.isatty()
+        self.stage = None
+        self.tenth = None
+
+    def __call__(self, progress):
+        if progress.bytes_total is None:
+            fraction = None
+            line = '{0} {1:.1f} MiB'.format(progress.stage, progress.bytes_done / 2**20)
+        else:
+            fraction = progress.bytes_done / progress.bytes_total if progress.bytes_total else 1.0
+            line = '{0} {1:>3.0f}%'.format(progress.stage, fraction * 100.0)
+        if progress.lines is not None:
+            line += ' {0} lines'.format(progress.lines)
+        if progress.eta_s is not None and fraction < 1.0:
+            line += ' {0:.0f}s left'.format(progress.eta_s)
+
+        finished = fraction is not None and fraction >= 1.0
+        tenth = None if fraction is None else int(fraction * 10)
+        if self.tty:
+            print('\x1b[2K\r' + line, end='\n' if finished else '', file=self.stream, flush=True)
+        elif progress.stage != self.stage or tenth != self.tenth:
+            print(line, file=self.stream, flush=True)
+        self.stage = None if finished else progress.stage
+        self.tenth = tenth
+
+
+class StageProfiler:
+    '''Wall time, CPU time and memory peak of the stages of a conversion.
+
+    convertFile wraps its stages in span(); the memory peak is how far the
+    Python allocations tracemalloc sees rose above what was allocated when
+    the stage started. Tracing slows conversion down quite a bit while it's
+    on. With dump, the stage named by profiled is also run under cProfile
+    and its stats are written to dump for pstats or snakeviz. Both only see
+    this process, not the workers of a parallel conversion.
+    '''
+
+    def __init__(self, trace_memory=True, dump=None, profiled='toolpath'):
+        self.trace_memory = trace_memory
+        self.dump = dump
+        self.profiled = profiled
+        # name -> [wall_s, cpu_s, peak_bytes]
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        profile = None
+        if self.dump is not None and name == self.profiled:
+            import cProfile
+            profile = cProfile.Profile()
+        stop = self.trace_memory and not tracemalloc.is_tracing()
+        if stop:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        # the peak is counted above what was allocated when the stage started
+        base = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            spent = [time.perf_counter() - wall, time.process_time() - cpu, None]
+            if self.trace_memory:
+                spent[2] = tracemalloc.get_traced_memory()[1] - base
+                if stop:
+                    tracemalloc.stop()
+            # a stage entered twice adds up its times and keeps the higher peak
+            if name in self.stages:
+                previous = self.stages[name]
+                spent = [previous[0] + spent[0], previous[1] + spent[1],
+                         None if spent[2] is None else max(previous[2], spent[2])]
+            self.stages[name] = spent
+            if profile is not None:
+                profile.dump_stats(self.dump)
+
+    def report(self, stream=None):
+        '''Print a table of the stages to stream, stdout by default'''
+        stream = sys.stdout if stream is None else stream
+        print('{0:<12} {1:>10} {2:>10} {3:>12}'.format('stage', 'wall s', 'cpu s', 'peak MiB'), file=stream)
+        for name, (wall, cpu, peak) in self.stages.items():
+            print('{0:<12} {1:>10.3f} {2:>10.3f} {3:>12}'.format(
+                name, wall, cpu, '' if peak is None else '{0:.1f}'.format(peak / 2**20)), file=stream)
+        print('{0:<12} {1:>10.3f} {2:>10.3f}'.format(
+            'total', sum(wall for wall, _, _ in self.stages.values()),
+            sum(cpu for _, cpu, _ in self.stages.values())), file=stream)
+        if self.dump is not None and self.profiled in self.stages:
+            print('cProfile stats of', self.profiled, 'written to', self.dump, file=stream)
+
+
+def profileStage(profiler, name):
+    '''profiler.span(name), or nothing at all without a profiler'''
+    return contextlib.nullcontext() if profiler is None else profiler.span(name)
+
+
+# Comment lines slicers put at the start of every layer. Toolpath statistics are
+# kept per layer and parallel conversion splits the gcode in front of these.
+LAYER_MARKERS = (b';LAYER:', b';LAYER_CHANGE')
+
+
+def processGcode(corpus, state, report=None):
+    '''Run every line of corpus through the handlers, writing to the state's writer.
+
+    corpus yields the gcode lines as bytes, see readGcode. Moves and comments
+    are parsed as bytes, only the other commands are decoded for their handler.
+    report, when given, is called with the line number and the number of
+    bytes read every PROGRESS_LINES lines, it is up to report to throttle.
+    If state has a 'thumbnails' dict the thumbnails embedded in the gcode are
+    decoded into it. Commands without a handler are counted in stats.ignored.
+    '''
+    writer = state['writer']
+    thumbnails = state.get('thumbnails')
+    stats = state['stats']
+    axis = state['axis']
+    printeroffset = state['printeroffset']
+    handlers = GCODE_HANDLERS
+    fastMove = None if DEBUG else FAST_MOVE.match
+    ignored = stats.ignored
+    bytesread = 0
+    linenum = 0
+
+    # name and base64 lines of the thumbnail being read
+    thumbnail = None
+    thumbnail_data = None
+
+    for linenum, line in enumerate(corpus, start=1):
+        bytesread += len(line)
+
+        if linenum == 1 and thumbnails is not None and not hasThumbnails(line):
+            thumbnails = None
+
+        if report is not None and (linenum % PROGRESS_LINES) == 0:
+            report(linenum, bytesread)
+
+        if line.startswith(b';'):
+            if line.startswith(LAYER_MARKERS):
+                writer.newLayer()
+                if line.startswith(b';LAYER:'):
+                    sec = int(line.split(b':', 1)[1])
+                    # We add the first section manually
+                    if sec > 0:
+                        writer.comment(f'Layer Section {sec} ({sec})')
+                        writer.comment('Material 0')
+            elif thumbnail_data is not None:
+                if b"thumbnail end" in line:
+                    thumbnails[thumbnail] = base64.b64decode(b''.join(thumbnail_data))
+                    thumbnail_data = None
                 else:
-                    if prev['a'] < axis['a']:
-                        tag = 'Infill'
-                    elif prev['a'] == axis['a']:
-                        tag = 'Leaky Travel Move'
-                    elif axis['a'] < prev['a']:
-                        tag = 'Retract'
-
-                processed += generateCommand('move',
-                                             {'relative': {'a': False,
-                                                           'x': False,
-                                                           'y': False,
-                                                           'z': False}},
-                                             axis,
-                                             [tag])
-
-                printersettings['time'] += computeTime(prev, axis)
-
-                if prev['z'] < axis['z']:
-                    printersettings['z_transitions'] += 1
-
-        elif line[0] == 'M82':
-            # E absolute
-            pass
-
-        elif line[0] == 'G92':
-            for ax in line[1:]:
-                if ax[0] == 'E':
-                    printeroffset['a'] = axis['a'] + float(ax[1:])
-                elif ax[0] == 'X':
-                    printeroffset['x'] = axis['x'] + float(ax[1:])
-                elif ax[0] == 'Y':
-                    printeroffset['y'] = axis['y'] + float(ax[1:])
-                elif ax[0] == 'Z':
-                    printeroffset['z'] = axis['z'] + float(ax[1:])
-
-        elif line[0] == 'M104':
-            for ax in line[1:]:
-                if ax[0] == 'T':
-                    tempmetadata['index'] = int(ax[1:])
-                elif ax[0] == 'S':
-                    tempmetadata['temperature'] = int(ax[1:])
-                    if tempmetadata['temperature'] != 0:
-                        if printersettings['extruder_temperature'] == 0:
-                            printersettings['extruder_temperature'] = tempmetadata['temperature']
-                        else:
-                            print('\x1b[2K\rMultiple temperatures issued during print, using only first.')
-            if tempmetadata['index'] != -1:
-                processed += generateCommand('set_toolhead_temperature',
-                                             {},
-                                             tempmetadata,
-                                             [])
-                if printersettings['tool{}temp'.format(tempmetadata['index'])] == 0:
-                    printersettings['tool{}temp'.format(tempmetadata['index'])] = tempmetadata['temperature']
-            else:  # there is only one extruder
-                processed += generateCommand('set_toolhead_temperature',
-                                             {},
-                                             {'temperature': tempmetadata['temperature']},
-                                             [])
-                printersettings['tool0temp'] = tempmetadata['temperature']
-
-        elif line[0] == 'M105':
-            # Report temp
-            pass
-
-        elif line[0] == 'M109':
-            # Wait for hotend temp
-            pass
-
-        elif line[0] == 'M106':
-            for ax in line[1:]:
-                if ax[0] == 'P':
-                    fanduty['index'] = int(ax[1:])
-                    fanstatus['index'] = int(ax[1:])
-                elif ax[0] == 'S':
-                    fanduty['value'] = float(ax[1:]) / 255
-            if not fanstatus['value']:
-                fanstatus['value'] = True
-                processed += generateCommand('toggle_fan',
-                                             {},
-                                             fanstatus,
-                                             [])
-            processed += generateCommand('fan_duty',
-                                         {},
-                                         fanduty,
-                                         [])
-
-        elif line[0] == 'M107':
-            fanstatus['value'] = False
-            processed += generateCommand('toggle_fan',
-                                         {},
-                                         fanstatus,
-                                         [])
-
-        elif line[0] == 'M140':
-            printersettings['bedtemp'] = int(line[1][1:])
-            printersettings['heatbed'] = True
+                    thumbnail_data.append(thumbnailLine(line))
+            elif thumbnails is not None and b"thumbnail begin" in line:
+                thumbnail = thumbnailName(line)
+                thumbnail_data = []
+            continue
 
+        match = fastMove(line) if fastMove else None
+        if match is not None:
+            opcode, feed, x, y, z, e, feed2 = match.groups()
+            if x is None and y is None and z is None and e is None and feed2 is None and feed is not None:
+                axis['feedrate'] = float(feed) / 60.0
+                continue
+            prev = axis.copy()
+            if feed is not None:
+                axis['feedrate'] = float(feed) / 60.0
+            if x is not None:
+                axis['x'] = printeroffset['x'] + float(x)
+            if y is not None:
+                axis['y'] = printeroffset['y'] + float(y)
+            if z is not None:
+                axis['z'] = printeroffset['z'] + float(z)
+            if e is not None:
+                axis['a'] = printeroffset['a'] + float(e)
+            if feed2 is not None:
+                axis['feedrate'] = float(feed2) / 60.0
+            finishMove(state, MOVE_OPCODES[opcode], prev)
+            continue
+
+        words = line.split(b';', 1)[0].decode(errors='replace').split()
+        if not words:
+            continue
+
+        handler = handlers.get(words[0])
+        if handler is not None:
+            handler(state, words)
         else:
-            if ignoring:
-                print('   ', repr(line[0]), end='')
-            else:
-                ignoring = True
-                print('\n\nignoring', repr(line[0]), end='')
+            ignored[words[0]] += 1
         if DEBUG:
-            processed += generateCommand('comment', {}, {'comment': f'{line}'}, [])
-
-    print()
-    print('writing toolpath')
-    lines = [
-        '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Layer Section 0 (0)"},"tags":[]}},',
-        '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Material 0"},"tags":[]}},',
-        '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Lower Position  0"},"tags":[]}},',
-        '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Upper Position  0.3"},"tags":[]}},',
-        '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Thickness       0.3"},"tags":[]}},',
-        '{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"Width           2.5"},"tags":[]}},',
-        '{"command" : {"function":"move","metadata":{"relative":{"a":false,"x":false,"y":false,"z":false}},"parameters":{"a":0.0,"feedrate":23.0,"x":-50.0,"y":-50.0,"z":0.30},"tags":["Travel Move"]}},']
-    lines += [f'{json.dumps(c, sort_keys=False)},' for c in processed]
-    lines += ['{"command" : {"function":"comment","metadata":{},"parameters":{"comment":"End of print"},"tags":[]}}']
-    # compiledtoolpath = json.dumps(processed, sort_keys=False, indent=4)
-    with open('{}/print.jsontoolpath'.format(temp), 'w') as toolpathfile:
-        toolpathfile.write("\n".join(["[", *lines, "]"]))
-
-    print('checking toolpath')
-    assert printersettings['extruder_temperature'] > 0
-    with open('{}/print.jsontoolpath'.format(temp), 'r') as toolpathfile:
-        json.load(toolpathfile)
-
-    print('collecting printer settings')
-
-    printersettings['toolpathfilelength'] = len(lines)
-
-    printersettings['extrusion_distance'] = max(c['command']['parameters']['a']
-                                                for c in processed
-                                                if c['command']['function'] == 'move')
-
-    printcoords = [cmd['command']['parameters'] for cmd in processed
-                   if set(cmd['command']['tags']) & {'Infill', 'Leaky Travel Move'}]
-
-    bbox = {'x_max': max(c['x'] for c in printcoords),
-            'x_min': min(c['x'] for c in printcoords),
-            'y_max': max(c['y'] for c in printcoords),
-            'y_min': min(c['y'] for c in printcoords),
-            'z_max': max(c['z'] for c in printcoords),
-            'z_min': min(c['z'] for c in printcoords)}
-    # for c in printcoords:
-    #    print(c)
-    # input('press')
-    print(bbox)
-
-    # Make sure bounding box is centered near the origin in X/Y and at the bottom of Z.
-    xrel = (bbox['x_max'] + bbox['x_min']) / (bbox['x_max'] - bbox['x_min'])
-    yrel = (bbox['y_max'] + bbox['y_min']) / (bbox['y_max'] - bbox['y_min'])
-    zrel = (bbox['z_max'] + bbox['z_min']) / (bbox['z_max'] - bbox['z_min'])
-    print('xrel:')
-    print(xrel)
-    print('yrel:')
-    print(yrel)
-    print('zrel:')
-    print(zrel)
-    assert -0.15 < xrel < 0.15, xrel
-    assert -0.15 < yrel < 0.15, yrel
-    # assert  0.95 < zrel < 1.05, zrel
-    assert 0 < bbox['z_min'] < 0.5, bbox['z_min']
-
-    printersettings['bounding_box'] = bbox
+            writer.comment(f'{words}')
+
+    if thumbnail_data is not None:
+        thumbnails[thumbnail] = base64.b64decode(b''.join(thumbnail_data))
+    stats.lines += linenum
+    return linenum
+
+
+# Parallel conversion
+#
+# The gcode is cut into chunks of whole layers. Each worker first summarizes the
+# lines of its chunk that change the machine state, the parent replays those
+# summaries in order to find the state every chunk starts in, then the workers
+# convert their chunks and the results are stitched together in order.
+
+STATE_KEYS = ('axis', 'tempmetadata', 'fanstatus', 'fanduty', 'printersettings', 'printeroffset')
+PARALLEL_MIN_CHUNK = 1024 * 1024
+PARALLEL_CHUNKS_PER_JOB = 4
+
+LAYER_START = re.compile(b'^(?:' + b'|'.join(re.escape(marker) for marker in LAYER_MARKERS) + b')', re.M)
+# Non-move lines with a handler that changes the machine state
+STATE_LINE = re.compile(rb'^(?:G92|M104|M106|M107|M140)(?=[ \t\r\n;]|$)[^\n]*', re.M)
+# The last value of one axis word in the G0-G3 lines of a span, the leading .* makes
+# the regex engine search backwards from the end of the span.
+LAST_AXIS_WORD = {letter: re.compile(rb'(?s:.*)^G[0-3](?=[ \t\r\n;]|$)[^\n;]*[ \t]' + letter.encode() + rb'([^\s;]+)', re.M)
+                  for letter in 'XYZEF'}
+AXIS_LETTERS = {'X': 'x', 'Y': 'y', 'Z': 'z', 'E': 'a'}
+
+
+def splitGcode(filename, chunks):
+    '''Byte ranges of filename cut at layer markers into roughly `chunks` pieces'''
+    size = os.path.getsize(filename)
+    if size == 0:
+        return [(0, 0)]
+    target = max(size // chunks, PARALLEL_MIN_CHUNK)
+    bounds = [0]
+    with open(filename, 'rb') as gcodefile, \
+            mmap.mmap(gcodefile.fileno(), 0, access=mmap.ACCESS_READ) as gcode:
+        for marker in LAYER_START.finditer(gcode):
+            if marker.start() - bounds[-1] >= target:
+                bounds.append(marker.start())
+    bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def scanChunk(filename, chunk):
+    '''Summarize how a chunk changes the machine state.
+
+    Returns, in file order, the words of every state changing non-move line and
+    for the moves between those the last value of each axis word.
+    '''
+    start, end = chunk
+    summary = []
+    if start == end:
+        return summary
+
+    with open(filename, 'rb') as gcodefile, \
+            mmap.mmap(gcodefile.fileno(), 0, access=mmap.ACCESS_READ) as gcode:
+
+        def lastAxisWords(spanstart, spanend):
+            words = {}
+            for letter, pattern in LAST_AXIS_WORD.items():
+                match = pattern.match(gcode, spanstart, spanend)
+                if match is not None:
+                    words[letter] = match.group(1).decode()
+            if words:
+                summary.append(('moves', words))
+
+        # chunks start at a line, so ^ matches at their first byte
+        spanstart = start
+        for line in STATE_LINE.finditer(gcode, start, end):
+            lastAxisWords(spanstart, line.start())
+            summary.append(('line', line.group().decode(errors='replace').split(';', 1)[0].split()))
+            spanstart = line.end()
+        lastAxisWords(spanstart, end)
+    return summary
+
+
+def replayChunkSummary(state, summary):
+    '''Apply the output of scanChunk to state'''
+    axis = state['axis']
+    printeroffset = state['printeroffset']
+    for kind, words in summary:
+        if kind == 'moves':
+            for letter, value in words.items():
+                if letter == 'F':
+                    axis['feedrate'] = float(value) / 60.0
+                else:
+                    axis[AXIS_LETTERS[letter]] = printeroffset[AXIS_LETTERS[letter]] + float(value)
+        else:
+            GCODE_HANDLERS[words[0]](state, words)
+
+
+def convertChunk(filename, chunk, startstate, options):
+    '''Convert one chunk starting from startstate, with the options of createToolpath.
+
+    Returns the toolpath records, their statistics, the state the chunk ends in
+    and the thumbnails found in it.
+    '''
+    state = copy.deepcopy(startstate)
+    stats = ToolpathStats(options['limits'])
+    records = io.StringIO()
+    writer = newWriter(records, stats, options['coalesce'], options['precision'])
+    state['writer'] = writer
+    state['stats'] = stats
+    state['thumbnails'] = {}
+    state['arc_tolerance'] = options['arc_tolerance']
+    processGcode(readGcode(filename, *chunk), state)
+    writer.flush()
+    stats.flushMoves()
+    return records.getvalue(), stats, {key: state[key] for key in STATE_KEYS}, state['thumbnails']
+
+
+def untraced():
+    '''Pool initializer, forked workers would inherit the tracemalloc of a StageProfiler'''
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def convertChunks(filename, chunks, writer, jobs, thumbnails, report, options):
+    '''Convert chunks on a pool of jobs processes, in order, into writer.
+
+    Thumbnails go into the thumbnails dict, report is called like processGcode
+    calls it after every chunk, options go to convertChunk. Returns the state
+    at the end of the gcode.
+    '''
+    stats = writer.stats
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=untraced) as pool:
+        summaries = pool.map(scanChunk, itertools.repeat(filename), chunks)
+
+        # Collect the state every chunk starts with, no output is made while replaying
+        state = newToolpathState()
+        state['writer'] = ToolpathWriter(io.StringIO(), ToolpathStats())
+        state['stats'] = state['writer'].stats
+        startstates = []
+        for summary in summaries:
+            startstates.append(copy.deepcopy({key: state[key] for key in STATE_KEYS}))
+            replayChunkSummary(state, summary)
+
+        # Only keep a couple of converted chunks per worker in memory at a time
+        pending = collections.deque()
+        queued = zip(chunks, startstates)
+        for chunk, startstate in itertools.islice(queued, 2 * jobs):
+            pending.append(pool.submit(convertChunk, filename, chunk, startstate, options))
+
+        endstate = None
+        for chunk, startstate in zip(chunks, startstates):
+            records, chunkstats, chunkendstate, chunkthumbnails = pending.popleft().result()
+            for nextchunk, nextstate in itertools.islice(queued, 1):
+                pending.append(pool.submit(convertChunk, filename, nextchunk, nextstate, options))
+            if endstate is not None and startstate != endstate:
+                # The summary missed something, redo this chunk from the real state
+                records, chunkstats, chunkendstate, chunkthumbnails = convertChunk(filename, chunk, endstate, options)
+            writer.flush()
+            writer.toolpathfile.write(records)
+            stats.merge(chunkstats)
+            thumbnails.update(chunkthumbnails)
+            endstate = chunkendstate
+            report(stats.lines, chunk[1])
+    return endstate
+
+
+def createToolpath(gcode, toolpathfile, jobs=1, progress=None, machinetype=None, coalesce=None,
+                   arc_tolerance=ARC_TOLERANCE, precision=DEFAULT_PRECISION, validate=True):
+    '''Convert gcode to a jsontoolpath written to toolpathfile.
+
+    gcode is the path of a gcode file, or the gcode itself as bytes or a
+    readable binary stream. It is read lazily and every command is written
+    out as soon as it is produced, so memory use does not depend on the size
+    of the input. With jobs > 1 a file is converted in layer chunks on that
+    many processes, the result is identical to a serial conversion. The
+    thumbnails found in the gcode are returned under 'thumbnails', in the
+    same form as generateThumbnails returns them, the commands that were
+    skipped under 'ignored' and the number of nonzero extruder temperatures
+    after the first under 'extra_temperatures'. progress is a callback
+    taking a Progress, by default it is printed to the console.
+
+    'time' is the commanded duration of the print. With a machinetype its
+    acceleration is taken into account for the estimated 'duration', and
+    'layer_durations' has the estimate for every layer.
+
+    With coalesce, runs of collinear moves that stay within coalesce mm of a
+    single move are written as that move, 'coalesced' counts the commands saved.
+    Arcs are split into moves no more than arc_tolerance mm off the arc.
+    Move parameters are written with the decimals in precision, None writes
+    them with full float precision. validate=False skips the sanity checks of
+    the finished toolpath, for gcode that wasn't sliced for a MakerBot.
+    '''
+    # no number of moves gets an arc within 0 mm of itself
+    if not arc_tolerance > 0.0:
+        raise ValueError('arc_tolerance must be positive, not {0!r}'.format(arc_tolerance))
+    if progress is None:
+        progress = ConsoleProgress()
+    report = ProgressReporter(progress, 'converting', gcodeSize(gcode))
+    options = {'limits': None if machinetype is None else MOTION_LIMITS[machinetype],
+               'coalesce': coalesce,
+               'arc_tolerance': arc_tolerance,
+               'precision': precision}
+    stats = ToolpathStats(options['limits'])
+    writer = newWriter(toolpathfile, stats, coalesce, precision)
+    thumbnails = {}
+    # only a file can be split for the workers, gcode in memory is converted here
+    chunks = splitGcode(gcode, jobs * PARALLEL_CHUNKS_PER_JOB) if jobs > 1 and isGcodePath(gcode) else None
+
+    writer.begin()
+    report(0, 0)
+    if chunks is not None and len(chunks) > 1:
+        state = convertChunks(gcode, chunks, writer, jobs, thumbnails, report, options)
+    else:
+        state = newToolpathState()
+        state['writer'] = writer
+        state['stats'] = stats
+        state['thumbnails'] = thumbnails
+        state['arc_tolerance'] = arc_tolerance
+        processGcode(gcodeLines(gcode), state, report)
+    writer.end()
+    report.finish(stats.lines)
+
+    ProgressReporter(progress, 'checking', 1).finish()
+    printersettings = state['printersettings']
+    if validate:
+        stats.validate(printersettings)
+    printersettings.update(stats.settings())
+    # meta.json can't hold them, Infinity and NaN aren't JSON
+    if not math.isfinite(printersettings['time']) or not math.isfinite(printersettings['duration']):
+        raise ValueError('print time estimate is not finite: time {0!r}, duration {1!r}'.format(
+            printersettings['time'], printersettings['duration']))
+    printersettings['ignored'] = dict(stats.ignored)
+    printersettings['thumbnails'] = thumbnails
 
     return printersettings
 
 
-def packageMBotFile(filename, temp, tnNames):
-    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as mbotfile:
-        for tn in tnNames:
-            mbotfile.write(tn.format(temp), arcname=tn.strip("{}/"))
-        mbotfile.write('{}/meta.json'.format(temp), arcname='meta.json')
-        mbotfile.write('{}/print.jsontoolpath'.format(temp), arcname='print.jsontoolpath')
+# Past this size the toolpath member may outgrow the 4 GiB a plain zip entry can hold
+ZIP64_GCODE_SIZE = 256 * 1024 * 1024
+
+
+@contextlib.contextmanager
+def openToolpath(mbotfile, force_zip64=False):
+    '''Open print.jsontoolpath in mbotfile as a text stream createToolpath can write to'''
+    with mbotfile.open('print.jsontoolpath', 'w', force_zip64=force_zip64) as member:
+        with io.TextIOWrapper(member, encoding='utf-8', newline='\n') as toolpathfile:
+            yield toolpathfile
+
+
+def packageMBotFile(mbotfile, meta, thumbnails):
+    '''Add meta.json and the thumbnails to an open .makerbot archive'''
+    mbotfile.writestr('meta.json', json.dumps(meta, indent=4))
+    for name, data in thumbnails.items():
+        mbotfile.writestr(name, data)
     return
 
-def main(filename, printer, extruder, slicer):
+
+# Printer and extruder names as given on the command line or by the GUI's choice index
+PRINTER_NAMES = {name: machinetype for machinetype in MachineType
+                 for name in PRINTER_PROFILES[machinetype.name].names}
+EXTRUDER_NAMES = {name: extrudertype for extrudertype in ExtruderType
+                  for name in EXTRUDER_PROFILES[extrudertype.name].names}
+
+
+def parseMachineType(printer):
+    # If you need to change it and you aren't using the post processing script change the default to match whichever machine your using,
+    # otherwise use the corresponding -Machine in your post processing setup.
+    return PRINTER_NAMES.get(printer, MachineType.REPLICATORPlUS)
+
+
+def parseExtruderType(extruder):
+    # The post processing setup passes these as -SmartExt etc.
+    return EXTRUDER_NAMES.get(extruder.lstrip('-'), ExtruderType.SMARTEXTRUDERPLUS)
+
+
+def parsePrecision(text):
+    '''Precision from the command line, "full" or a comma separated list like "x=3,feedrate=1"'''
+    if text == 'full':
+        return None
+    precision = dict(DEFAULT_PRECISION)
+    for item in text.split(','):
+        name, _, digits = item.partition('=')
+        name = name.strip().lower()
+        if name not in precision or not digits.strip().isdigit():
+            raise ValueError('invalid precision {!r}, expected full or {}'.format(
+                item, ','.join('{}=N'.format(name) for name in precision)))
+        precision[name] = int(digits)
+    return precision
+
+
+def parseArcTolerance(text):
+    '''Arc tolerance from the command line, a positive number of mm'''
+    tolerance = float(text)
+    if not tolerance > 0.0:
+        raise ValueError('invalid arc tolerance {!r}, expected a positive number of mm'.format(text))
+    return tolerance
+
+
+def makerbotFilename(filename):
+    '''The .makerbot path next to a gcode file'''
+    root, ext = os.path.splitext(filename)
+    if ext.lower() != '.gcode':
+        root = filename
+    return root + '.makerbot'
+
+
+def quiet(*args):
+    '''A progress callback or log that drops everything'''
+
+
+def writeMakerbot(gcode, output, machinetype, extrudertype, jobs=1, progress=None, coalesce=None,
+                  arc_tolerance=ARC_TOLERANCE, precision=DEFAULT_PRECISION, validate=True, profiler=None, log=quiet):
+    '''Convert gcode to a .makerbot archive written to output, a path or a writable binary stream.
+
+    Returns the createToolpath results and the meta.json contents. log is
+    called like print with what is being done, the other arguments are those
+    of convertFile.
+    '''
+    if progress is None:
+        progress = ConsoleProgress()
+    size = gcodeSize(gcode)
+    # Everything is streamed straight into the archive, nothing is staged on disk
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as mbotfile:
+        log('Generating toolpath for', output)
+        # a stream of unknown size might be a big one
+        with profileStage(profiler, 'toolpath'), \
+                openToolpath(mbotfile, size is None or size > ZIP64_GCODE_SIZE) as toolpathfile:
+            vardict = createToolpath(gcode, toolpathfile, jobs, progress, machinetype, coalesce,
+                                     arc_tolerance, precision, validate)
+        if coalesce:
+            log('merged', vardict['coalesced'], 'collinear moves')
+        if vardict['ignored']:
+            log('ignored', ', '.join('{0!r} ({1}x)'.format(opcode, count)
+                                     for opcode, count in vardict['ignored'].items()))
+        if vardict['extra_temperatures']:
+            log('Multiple temperatures issued during print, using only first.')
+        log(vardict['bounding_box'])
+        log('Generating metadata for', output)
+        with profileStage(profiler, 'metadata'):
+            meta = fillMetaTemplate(vardict, machinetype, extrudertype)
+        # the thumbnails were decoded while reading the gcode, profiling counts them in toolpath
+        thumbnails = vardict['thumbnails']
+        log(len(thumbnails), 'Thumbnails(s) generated')
+        ProgressReporter(progress, 'packaging', 1).finish()
+        with profileStage(profiler, 'packaging'):
+            packageMBotFile(mbotfile, meta, thumbnails)
+            # the central directory is written on close
+            mbotfile.close()
+    # the caller gets a meta.json of its own, not one sharing the template
+    return vardict, copy.deepcopy(meta)
+
+
+def convertFile(filename, output, machinetype, extrudertype, jobs=1, cache=None, progress=None, coalesce=None,
+                arc_tolerance=ARC_TOLERANCE, precision=DEFAULT_PRECISION, validate=True, profiler=None):
+    '''Convert the gcode in filename to the .makerbot archive output.
+
+    Raises on failure, after removing the partially written archive. With a
+    mbotmake_cache.ConversionCache a previous conversion of the same gcode
+    and settings is copied instead, in that case None is returned. progress
+    coalesce, arc_tolerance, precision and validate are passed on to
+    createToolpath. With a StageProfiler the stages are timed in its spans.
+    '''
+    if progress is None:
+        progress = ConsoleProgress()
+    if cache is not None:
+        key = cache.key(filename, machinetype, extrudertype, coalesce=coalesce, arc_tolerance=arc_tolerance,
+                        precision=None if precision is None else sorted(precision.items()), validate=validate)
+        if cache.fetch(key, output):
+            print('Using cached conversion for', output)
+            ProgressReporter(progress, 'done', 1).finish()
+            return None
+    try:
+        vardict, _ = writeMakerbot(filename, output, machinetype, extrudertype, jobs, progress, coalesce,
+                                   arc_tolerance, precision, validate, profiler, log=print)
+    except BaseException:
+        # don't leave a half written archive behind
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+    if cache is not None:
+        cache.store(key, output)
+    ProgressReporter(progress, 'done', 1).finish()
+    return vardict
+
+
+# What convertGcode returns: makerbot is the archive unless it went to a stream,
+# meta the meta.json contents and error why the conversion failed.
+ConversionResult = collections.namedtuple('ConversionResult', ['ok', 'makerbot', 'meta', 'stats', 'error'])
+
+
+def convertGcode(gcode, machinetype, extrudertype, output=None, progress=quiet, coalesce=None,
+                 arc_tolerance=ARC_TOLERANCE, precision=DEFAULT_PRECISION, validate=True):
+    '''Convert gcode held in memory to a .makerbot, without touching the file system.
+
+    gcode is bytes or a readable binary stream. The archive is written to
+    output, a writable binary stream, and otherwise returned as bytes in the
+    result's makerbot. Nothing is printed, and a gcode that can't be
+    converted doesn't raise: the result has ok False and the reason in
+    error, whatever was written to output by then is incomplete. stats has
+    what createToolpath found out about the toolpath, with the names of the
+    thumbnails instead of their data.
+    '''
+    if not isinstance(machinetype, MachineType):
+        raise TypeError('machinetype must be a MachineType, not {0!r}'.format(machinetype))
+    if not isinstance(extrudertype, ExtruderType):
+        raise TypeError('extrudertype must be an ExtruderType, not {0!r}'.format(extrudertype))
+    if isGcodePath(gcode):
+        raise TypeError('gcode must be bytes or a binary stream, convertFile converts files')
+    target = io.BytesIO() if output is None else output
+    try:
+        vardict, meta = writeMakerbot(gcode, target, machinetype, extrudertype, 1, progress, coalesce,
+                                      arc_tolerance, precision, validate)
+    except Exception as e:
+        return ConversionResult(False, None, None, None, '{0}: {1}'.format(type(e).__name__, e))
+    stats = dict(vardict)
+    stats['thumbnails'] = list(vardict['thumbnails'])
+    return ConversionResult(True, target.getvalue() if output is None else None, meta, stats, None)
+
+
+def main(filename, printer, extruder, slicer, jobs=1, cache=None, progress=None, coalesce=None,
+         arc_tolerance=ARC_TOLERANCE, precision=DEFAULT_PRECISION, profiler=None):
     try:
         print(printer)
-        # If you need to change it and you aren't using the post processing script change these 2 lines to match whichever machine and extruder your using,
-        # otherwise use the corresponding -Machine, and -extruder in your post processing setup.
-        machinetype = MachineType.REPLICATORPlUS
-        extrudertype = ExtruderType.SMARTEXTRUDERPLUS
         slicerScript = False
-        temp = tempfile.mkdtemp()
 
         if "prusa" in slicer:
             #slicerScript = True
@@ -869,60 +1783,28 @@ def main(filename, printer, extruder, slicer):
             #slicerScript = True
             print("orca")
 
-        if printer == "MiniPlus" or printer == "3":
-            machinetype = MachineType.REPLICATORMINIPLUS
-            print("MiniPlus")
-        if printer == "RepPlus" or printer == "0":
-            machinetype = MachineType.REPLICATORPlUS
-            print("RepPlus")
-        if printer == "Mini5" or printer == "2":
-            machinetype = MachineType.REPLICATORMINI
-            print("Mini5")
-        if printer == "1" or printer == "Rep5" in printer:
-            machinetype = MachineType.REPLICATOR5
-            print("Rep5")
-
-        if extruder == "-SmartExtPlus" or extruder == "0":
-            extrudertype = ExtruderType.SMARTEXTRUDERPLUS
-            print("SmartExtPlus")
-
-        if extruder == "-SmartExt"  or extruder ==  "1":
-            extrudertype = ExtruderType.SMARTEXTRUDER
-            print("SmartExt")
-
-        if extruder == "-ToughExt" or extruder == "2":
-            extrudertype = ExtruderType.TOUGHEXTRUDER
-            print("ToughExt")
-
-        if extruder == "-ExperimentalExt" or extruder == "3" in extruder:
-            extrudertype = ExtruderType.EXPERIMENTALEXTRUDER
-            print("ExperimentalExt")
+        machinetype = parseMachineType(printer)
+        extrudertype = parseExtruderType(extruder)
 
         if slicerScript:
-            output = str(getenv('SLIC3R_PP_OUTPUT_NAME')).replace('.gcode', '.makerbot')
+            output = makerbotFilename(str(getenv('SLIC3R_PP_OUTPUT_NAME')))
         else:
-            output = filename.replace('.gcode', '.makerbot')
-
+            output = makerbotFilename(filename)
 
         print("Printer: ", machinetype)
         print("Extruder: ", extrudertype)
-        print('Generating toolpath for', output)
-        status="Generating Toolpath for " + output
-        vardict = createToolpath(filename, temp)
-        print('Generating metadata for', output)
-        status = "Generating Metadata"
-        generateMetajson(temp, vardict, machinetype, extrudertype)
-        print('Generating thumbnails for', output)
-        status = "Generating Thumbnails"
-        tnNames = generateThumbnails(filename, temp)
-        print(len(tnNames), 'Thumbnails(s) generated')
-        print('Packaging', output)
-        packageMBotFile(output, temp, tnNames)
+        convertFile(filename, output, machinetype, extrudertype, jobs, cache, progress, coalesce, arc_tolerance,
+                    precision, profiler=profiler)
         print(output, 'done!')
-        status = "Done!"
+        if profiler is not None:
+            profiler.report()
 
         return True
 
+    except ConversionCancelled:
+        print()
+        print('Cancelled')
+        return False
     except Exception as e:
         print()
         print('An Error')
@@ -931,13 +1813,34 @@ def main(filename, printer, extruder, slicer):
 
 
 if __name__ == '__main__':
+    import mbotmake_cache
+
     parser = argparse.ArgumentParser(
         prog='mbotmake',
         description='Convert GCode to .Makerbot')
     parser.add_argument('filename')  # positional argument
-    parser.add_argument('-p' '--printer', default="RepPlus")  # option that takes a value
+    parser.add_argument('-p', '--printer', default="RepPlus")  # option that takes a value
     parser.add_argument('-e', '--extruder', default="SmartExtPlus")
     parser.add_argument('-s', '--slicer', default="prusa")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='convert layer chunks on this many processes')
+    parser.add_argument('--coalesce', type=float, metavar='MM',
+                        help='merge runs of collinear moves that stay within this distance of one move')
+    parser.add_argument('--arc-tolerance', type=parseArcTolerance, default=ARC_TOLERANCE, metavar='MM',
+                        help='how far the moves G2/G3 arcs are split into may be off the arc')
+    parser.add_argument('--precision', type=parsePrecision, default=DEFAULT_PRECISION,
+                        help='decimals of the move parameters, like x=3,y=3,z=3,a=5,feedrate=2, or full')
+    mbotmake_cache.addCacheArguments(parser)
+    parser.add_argument('--profile', action='store_true',
+                        help='print the time and memory every stage took')
+    parser.add_argument('--profile-dump', metavar='FILE',
+                        help='also write cProfile stats of the toolpath generation to FILE')
     args = parser.parse_args()
 
-    main(args.filename, args.printer, args.extruder, args.slicer)
+    cache = mbotmake_cache.cacheFromArguments(args)
+    profiler = None
+    if args.profile or args.profile_dump:
+        profiler = StageProfiler(dump=args.profile_dump)
+
+    main(args.filename, args.printer, args.extruder, args.slicer, args.jobs, cache,
+         coalesce=args.coalesce, arc_tolerance=args.arc_tolerance, precision=args.precision, profiler=profiler)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+'''Convert many gcode files to .makerbot in one go.
+
+Inputs can be files, directories or glob patterns. Files are converted on a
+pool of worker processes that stay up for the whole batch, a failing file is
+recorded in the summary and the batch carries on with the rest.
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import json
+import os
+import sys
+import time
+
+import mbotmake
+import mbotmake_cache
+
+
+def findGcode(paths, recursive=False):
+    '''Expand files, directories and glob patterns into a sorted list of gcode files'''
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            pattern = os.path.join(path, '**', '*.gcode') if recursive else os.path.join(path, '*.gcode')
+            found += glob.glob(pattern, recursive=recursive)
+        elif os.path.isfile(path):
+            found.append(path)
+        else:
+            found += [match for match in glob.glob(path, recursive=recursive) if os.path.isfile(match)]
+    # keep the first occurrence of every file
+    return sorted(dict.fromkeys(os.path.normpath(path) for path in found))
+
+
+def convertOne(filename, machinetype, extrudertype, cache=None):
+    '''Convert a single file, returning its summary entry instead of raising'''
+    output = mbotmake.makerbotFilename(filename)
+    result = {'input': filename,
+              'output': output,
+              'status': 'ok',
+              'cached': False,
+              'error': None,
+              'duration_s': None,
+              'input_bytes': None,
+              'output_bytes': None}
+    start = time.perf_counter()
+    try:
+        result['input_bytes'] = os.path.getsize(filename)
+        # the per line progress of every worker would only interleave on the console
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            vardict = mbotmake.convertFile(filename, output, machinetype, extrudertype, cache=cache)
+        result['cached'] = vardict is None
+        result['output_bytes'] = os.path.getsize(output)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['output'] = None
+    result['duration_s'] = time.perf_counter() - start
+    return result
+
+
+def convertBatch(filenames, machinetype, extrudertype, jobs=1, cache=None):
+    '''Convert filenames on jobs processes, yielding summary entries as files finish'''
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(convertOne, filename, machinetype, extrudertype, cache) for filename in filenames]
+        for future in concurrent.futures.as_completed(futures):
+            yield future.result()
+
+
+def main(paths, printer, extruder, jobs=1, summary='-', recursive=False, cache=None):
+    machinetype = mbotmake.parseMachineType(printer)
+    extrudertype = mbotmake.parseExtruderType(extruder)
+    filenames = findGcode(paths, recursive)
+    print('Converting', len(filenames), 'file(s) on', jobs, 'process(es)', file=sys.stderr)
+
+    start = time.perf_counter()
+    results = {}
+    for result in convertBatch(filenames, machinetype, extrudertype, jobs, cache):
+        results[result['input']] = result
+        print('{status:>6} {input} ({duration_s:.2f}s)'.format(**result),
+              '' if result['error'] is None else result['error'], file=sys.stderr)
+
+    files = [results[filename] for filename in filenames]
+    report = {'printer': machinetype.name,
+              'extruder': extrudertype.name,
+              'jobs': jobs,
+              'total': len(files),
+              'succeeded': sum(1 for result in files if result['status'] == 'ok'),
+              'failed': sum(1 for result in files if result['status'] != 'ok'),
+              'cache_hits': sum(1 for result in files if result['cached']),
+              'cache_misses': sum(1 for result in files if result['status'] == 'ok' and not result['cached'])
+              if cache is not None else 0,
+              'duration_s': time.perf_counter() - start,
+              'files': files}
+
+    if summary == '-':
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(summary, 'w') as summaryfile:
+            json.dump(report, summaryfile, indent=4)
+    return report['failed'] == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='mbotmake_batch',
+        description='Convert many GCode files to .Makerbot')
+    parser.add_argument('paths', nargs='+', help='gcode files, directories or glob patterns')
+    parser.add_argument('-p', '--printer', default="RepPlus")
+    parser.add_argument('-e', '--extruder', default="SmartExtPlus")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of files converted at the same time')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='also look for gcode in subdirectories')
+    parser.add_argument('--summary', default='-',
+                        help='where to write the JSON summary, - for stdout')
+    mbotmake_cache.addCacheArguments(parser)
+    args = parser.parse_args()
+
+    cache = mbotmake_cache.cacheFromArguments(args)
+
+    sys.exit(0 if main(args.paths, args.printer, args.extruder, args.jobs, args.summary, args.recursive, cache) else 1)
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+'''Benchmark the conversion over the bundled testcases.
+
+Every input is run through the whole pipeline (convertFile) and through each
+of its stages on its own: createToolpath, generateMetajson,
+generateThumbnails and packageMBotFile. Each measurement runs in a freshly
+spawned process, so the peak RSS it reports belongs to that stage alone and
+no stage benefits from what an earlier one left in memory. Wall time is the
+median of the repeats.
+
+The results are written as JSON, and the same file can later be passed as
+--baseline to flag the stages that got slower, use more memory or write
+more output than the given thresholds allow.
+'''
+
+import argparse
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import zipfile
+
+import mbotmake
+import mbotmake_batch
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows, peak RSS isn't reported there
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TESTCASES = os.path.join(HERE, 'testcases')
+
+STAGES = ('pipeline', 'createToolpath', 'generateMetajson', 'generateThumbnails', 'packageMBotFile')
+# the stages that read the gcode, lines/s is only meaningful for those
+GCODE_STAGES = ('pipeline', 'createToolpath', 'generateThumbnails')
+
+# default regression thresholds, relative to the baseline
+MAX_SLOWDOWN = 0.10
+MAX_RSS_GROWTH = 0.10
+MAX_SIZE_GROWTH = 0.01
+# wall time differences below this are noise, whatever the relative change
+MIN_TIME_DELTA = 0.005
+
+
+def peakRSS():
+    '''Peak resident set size of this process in bytes, None where unknown'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def benchPipeline(filename, directory, settings):
+    output = os.path.join(directory, 'print.makerbot')
+    mbotmake.convertFile(filename, output, settings['machinetype'], settings['extrudertype'], settings['jobs'],
+                         progress=mbotmake.quiet, validate=False)
+    return os.path.getsize(output), None
+
+
+def benchToolpath(filename, directory, settings):
+    path = os.path.join(directory, 'print.jsontoolpath')
+    with open(path, 'w', encoding='utf-8', newline='\n') as toolpathfile:
+        vardict = mbotmake.createToolpath(filename, toolpathfile, settings['jobs'], mbotmake.quiet,
+                                          settings['machinetype'], validate=False)
+    return os.path.getsize(path), vardict
+
+
+def benchMetajson(filename, directory, settings):
+    meta = mbotmake.generateMetajson(settings['vardict'], settings['machinetype'], settings['extrudertype'])
+    return len(json.dumps(meta, indent=4).encode()), None
+
+
+def benchThumbnails(filename, directory, settings):
+    thumbnails = mbotmake.generateThumbnails(filename)
+    return sum(len(data) for data in thumbnails.values()), None
+
+
+def benchPackage(filename, directory, settings):
+    output = os.path.join(directory, 'package.makerbot')
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as mbotfile:
+        mbotmake.packageMBotFile(mbotfile, settings['meta'], settings['vardict']['thumbnails'])
+    return os.path.getsize(output), None
+
+
+BENCHMARKS = {
+    'pipeline': benchPipeline,
+    'createToolpath': benchToolpath,
+    'generateMetajson': benchMetajson,
+    'generateThumbnails': benchThumbnails,
+    'packageMBotFile': benchPackage,
+}
+
+
+def runStage(stage, filename, settings, repeat):
+    '''Time repeat runs of stage on filename, this runs in its own process'''
+    benchmark = BENCHMARKS[stage]
+    walltimes = []
+    cputimes = []
+    vardict = None
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            outputbytes, vardict = benchmark(filename, directory, settings)
+            cputimes.append(time.process_time() - cpu)
+            walltimes.append(time.perf_counter() - wall)
+    return {'wall_s_runs': walltimes,
+            'cpu_s_runs': cputimes,
+            'peak_rss_bytes': peakRSS(),
+            'output_bytes': outputbytes,
+            'vardict': vardict}
+
+
+def measure(stage, filename, settings, repeat):
+    '''runStage in a new process, so its peak RSS isn't that of an earlier measurement'''
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(runStage, stage, filename, settings, repeat).result()
+
+
+def inputName(filename):
+    '''How filename is named in the results, relative to the repository so baselines of other checkouts match'''
+    path = os.path.abspath(filename)
+    try:
+        relative = os.path.relpath(path, HERE)
+    except ValueError:
+        return path  # on another drive
+    return path if relative.startswith(os.pardir) else relative.replace(os.sep, '/')
+
+
+def describeInput(filename):
+    '''Size, line count and hash of a benchmark input'''
+    digest = hashlib.sha256()
+    lines = 0
+    with open(filename, 'rb') as gcodefile:
+        for block in iter(lambda: gcodefile.read(1024 * 1024), b''):
+            digest.update(block)
+            lines += block.count(b'\n')
+    return {'input_bytes': os.path.getsize(filename),
+            'lines': lines,
+            'sha256': digest.hexdigest()}
+
+
+def benchmarkFile(filename, stages, settings, repeat):
+    '''Yield the result of every stage in stages for filename'''
+    described = describeInput(filename)
+    settings = dict(settings)
+    # the metadata and packaging stages start from a finished toolpath
+    needstoolpath = 'generateMetajson' in stages or 'packageMBotFile' in stages
+    for stage in STAGES:
+        if stage not in stages and not (stage == 'createToolpath' and needstoolpath):
+            continue
+        measured = measure(stage, filename, settings, repeat)
+        if stage == 'createToolpath':
+            settings['vardict'] = measured['vardict']
+            settings['meta'] = mbotmake.generateMetajson(measured['vardict'], settings['machinetype'],
+                                                         settings['extrudertype'])
+        if stage not in stages:
+            continue
+        wall = statistics.median(measured['wall_s_runs'])
+        result = {'input': inputName(filename),
+                  'stage': stage,
+                  'wall_s': wall,
+                  'cpu_s': statistics.median(measured['cpu_s_runs']),
+                  'lines_per_s': described['lines'] / wall if stage in GCODE_STAGES and wall > 0 else None,
+                  'peak_rss_bytes': measured['peak_rss_bytes'],
+                  'output_bytes': measured['output_bytes'],
+                  'wall_s_runs': measured['wall_s_runs']}
+        result.update(described)
+        yield result
+
+
+def environment():
+    return {'version': mbotmake.VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'numpy': mbotmake.numpy is not None,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def compare(results, baseline, slowdown=MAX_SLOWDOWN, rssgrowth=MAX_RSS_GROWTH, sizegrowth=MAX_SIZE_GROWTH,
+            mindelta=MIN_TIME_DELTA):
+    '''Yield (result, metric, old, new, regressed) for every result that is also in baseline'''
+    previous = {(entry['input'], entry['stage']): entry for entry in baseline['results']}
+    for result in results:
+        old = previous.get((result['input'], result['stage']))
+        if old is None:
+            continue
+        if old['sha256'] != result['sha256']:
+            yield result, 'sha256', old['sha256'][:12], result['sha256'][:12], False
+            continue
+        for metric, limit, floor in (('wall_s', slowdown, mindelta),
+                                     ('peak_rss_bytes', rssgrowth, 0),
+                                     ('output_bytes', sizegrowth, 0)):
+            if old[metric] is None or result[metric] is None:
+                continue
+            grown = result[metric] - old[metric]
+            regressed = grown > floor and grown > old[metric] * limit
+            yield result, metric, old[metric], result[metric], regressed
+
+
+def formatValue(value):
+    return '{:.4f}'.format(value) if isinstance(value, float) else str(value)
+
+
+def formatChange(old, new):
+    if isinstance(old, str):
+        return 'input changed'
+    if not old:
+        return ''
+    return '{:+.1%}'.format((new - old) / old)
+
+
+def main(paths, printer, extruder, stages, repeat=3, jobs=1, results='-', baseline=None, **thresholds):
+    settings = {'machinetype': mbotmake.parseMachineType(printer),
+                'extrudertype': mbotmake.parseExtruderType(extruder),
+                'jobs': jobs}
+    filenames = mbotmake_batch.findGcode(paths, recursive=True)
+    print('Benchmarking', len(filenames), 'file(s),', repeat, 'run(s) per stage', file=sys.stderr)
+
+    measured = []
+    for filename in filenames:
+        for result in benchmarkFile(filename, stages, settings, repeat):
+            measured.append(result)
+            print('{stage:>18} {wall_s:8.3f}s {rss:>8} {output_bytes:>10}B {input}'.format(
+                rss='' if result['peak_rss_bytes'] is None else '{:.1f}MiB'.format(result['peak_rss_bytes'] / 2**20),
+                **result), file=sys.stderr)
+
+    report = {'environment': environment(),
+              'printer': settings['machinetype'].name,
+              'extruder': settings['extrudertype'].name,
+              'jobs': jobs,
+              'repeat': repeat,
+              'results': measured}
+    if results == '-':
+        json.dump(report, sys.stdout, indent=4)
+        print()
+    else:
+        with open(results, 'w') as resultsfile:
+            json.dump(report, resultsfile, indent=4)
+
+    if baseline is None:
+        return True
+    with open(baseline) as baselinefile:
+        previous = json.load(baselinefile)
+    print('Compared to', baseline, '(version {version}, {created})'.format(**previous['environment']),
+          file=sys.stderr)
+    regressions = 0
+    for result, metric, old, new, regressed in compare(measured, previous, **thresholds):
+        regressions += regressed
+        print('{flag:>10} {stage:>18} {metric:>14} {old:>14} {new:>14} {change:>14} {input}'.format(
+            flag='REGRESSED' if regressed else '', stage=result['stage'], metric=metric,
+            old=formatValue(old), new=formatValue(new), change=formatChange(old, new), input=result['input']),
+            file=sys.stderr)
+    print(regressions, 'regression(s)', file=sys.stderr)
+    return regressions == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='mbotmake_bench',
+        description='Benchmark the GCode to .Makerbot conversion')
+    parser.add_argument('paths', nargs='*', default=[TESTCASES],
+                        help='gcode files, directories or glob patterns, the bundled testcases by default')
+    parser.add_argument('-p', '--printer', default="RepPlus")
+    parser.add_argument('-e', '--extruder', default="SmartExtPlus")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='processes createToolpath converts on')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='runs per stage, the median wall time is reported')
+    parser.add_argument('--stage', action='append', choices=STAGES, dest='stages',
+                        help='only benchmark this stage, can be given more than once')
+    parser.add_argument('--results', default='-',
+                        help='where to write the JSON results, - for stdout')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to check for regressions against')
+    parser.add_argument('--max-slowdown', type=float, default=MAX_SLOWDOWN,
+                        help='relative wall time increase counted as a regression')
+    parser.add_argument('--max-rss-growth', type=float, default=MAX_RSS_GROWTH,
+                        help='relative peak RSS increase counted as a regression')
+    parser.add_argument('--max-size-growth', type=float, default=MAX_SIZE_GROWTH,
+                        help='relative output size increase counted as a regression')
+    parser.add_argument('--min-time-delta', type=float, default=MIN_TIME_DELTA,
+                        help='wall time increases below this many seconds are never regressions')
+    args = parser.parse_args()
+
+    sys.exit(0 if main(args.paths, args.printer, args.extruder, args.stages or STAGES, args.repeat, args.jobs,
+                       args.results, args.baseline, slowdown=args.max_slowdown, rssgrowth=args.max_rss_growth,
+                       sizegrowth=args.max_size_growth, mindelta=args.min_time_delta) else 1)
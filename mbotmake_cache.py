@@ -0,0 +1,130 @@
+'''Content addressed cache of converted .makerbot files.
+
+Entries are keyed by a hash of the gcode bytes, the machine and extruder
+type with their profiles, the conversion options and the converter
+version, so any change to one of those is a miss. The cache directory is
+kept below a size limit by evicting the least recently used entries; a
+hit refreshes the entry's modification time, which is what the LRU order
+is based on.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import mbotmake
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def addCacheArguments(parser):
+    '''Add --cache-dir and --cache-size to the argparse parser of a CLI'''
+    parser.add_argument('--cache-dir', help='reuse earlier conversions stored in this directory')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help='size limit of the cache directory in MiB')
+
+
+def cacheFromArguments(args):
+    '''The ConversionCache the arguments of addCacheArguments ask for, None without --cache-dir'''
+    if not args.cache_dir:
+        return None
+    return ConversionCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+
+def defaultCacheDir():
+    '''Per user cache directory, following XDG on Linux'''
+    if os.name == 'nt':
+        base = os.getenv('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mbotmake')
+
+
+class ConversionCache:
+    SUFFIX = '.makerbot'
+
+    def __init__(self, directory, maxbytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, filename, machinetype, extrudertype, **options):
+        '''The cache key for converting filename with the given settings'''
+        digest = hashlib.sha256()
+        digest.update(repr((mbotmake.VERSION, machinetype.name, extrudertype.name,
+                            sorted(options.items()))).encode())
+        # editing profiles/ changes the output without a new VERSION. The limits are those of
+        # MOTION_LIMITS, looked up by name as the types may come from mbotmake run as __main__
+        digest.update(json.dumps([mbotmake.metaTemplate(machinetype, extrudertype),
+                                  mbotmake.PRINTER_PROFILES[machinetype.name].motion_limits], sort_keys=True).encode())
+        with open(filename, 'rb') as gcodefile:
+            for block in iter(lambda: gcodefile.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def fetch(self, key, output):
+        '''Copy the entry for key to output, returns False on a miss'''
+        entry = self.path(key)
+        try:
+            shutil.copyfile(entry, output)
+            os.utime(entry)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, key, makerbotfile):
+        '''Add a finished .makerbot to the cache and evict what no longer fits'''
+        # copy under a temporary name first so readers never see a partial entry
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(descriptor)
+        try:
+            shutil.copyfile(makerbotfile, temporary)
+            os.replace(temporary, self.path(key))
+        except BaseException:
+            os.remove(temporary)
+            raise
+        self.evict()
+
+    def entries(self):
+        '''(mtime, size, path) of every entry, least recently used first'''
+        entries = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(self.SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def statistics(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries()),
+                'bytes': self.size(),
+                'max_bytes': self.maxbytes}
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+'''Watch folders for new gcode and convert it to .makerbot as it arrives.
+
+The folders are polled, which works on network shares and systems without
+inotify; when the optional watchdog package is installed its file system
+events just wake the poller up early. Files that settled (same size and
+modification time on two polls) are put on a bounded queue served by warm
+worker processes. While the queue is full the poller waits, so a burst of
+new files can't pile up unbounded work.
+'''
+
+import argparse
+import concurrent.futures
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import mbotmake
+import mbotmake_batch
+import mbotmake_cache
+
+try:
+    import watchdog.events
+    import watchdog.observers
+except ImportError:
+    watchdog = None
+
+
+def isUpToDate(filename, output):
+    '''True if output exists and is at least as new as filename'''
+    try:
+        return os.path.getmtime(output) >= os.path.getmtime(filename)
+    except OSError:
+        return False
+
+
+class ConversionDaemon:
+    def __init__(self, folders, machinetype, extrudertype, jobs=1, queuesize=16, interval=2.0, recursive=False,
+                 cache=None):
+        self.folders = folders
+        self.cache = cache
+        self.machinetype = machinetype
+        self.extrudertype = extrudertype
+        self.jobs = jobs
+        self.interval = interval
+        self.recursive = recursive
+        self.jobqueue = queue.Queue(maxsize=queuesize)
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        # path -> (size, mtime) seen on the previous poll
+        self.seen = {}
+        # path -> mtime of the version that was queued or failed, so it isn't picked up twice
+        self.handled = {}
+        self.lock = threading.Lock()
+
+    def log(self, *args):
+        print(time.strftime('%Y-%m-%d %H:%M:%S'), *args, file=sys.stderr, flush=True)
+
+    def scan(self):
+        '''Yield the gcode files that stopped changing and have no up to date .makerbot'''
+        current = {}
+        for folder in self.folders:
+            for filename in mbotmake_batch.findGcode([folder], self.recursive):
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+                current[filename] = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            # forget files that were removed, so handled doesn't grow with every file ever dropped in
+            for filename in self.handled.keys() - current.keys():
+                del self.handled[filename]
+
+        for filename, signature in current.items():
+            if self.seen.get(filename) != signature:
+                continue  # new or still being written, look again next poll
+            with self.lock:
+                if self.handled.get(filename) == signature[1]:
+                    continue
+            if isUpToDate(filename, mbotmake.makerbotFilename(filename)):
+                continue
+            yield filename, signature[1]
+        self.seen = current
+
+    def poll(self):
+        while not self.stopping.is_set():
+            for filename, mtime in self.scan():
+                with self.lock:
+                    self.handled[filename] = mtime
+                self.log('queued', filename)
+                # blocks while the queue is full, which holds off further scanning
+                while not self.stopping.is_set():
+                    try:
+                        self.jobqueue.put((filename, mtime), timeout=self.interval)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stopping.is_set():
+                    return
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def work(self, pool):
+        while True:
+            job = self.jobqueue.get()
+            if job is None:
+                return
+            filename, mtime = job
+            try:
+                result = pool.submit(mbotmake_batch.convertOne, filename, self.machinetype, self.extrudertype,
+                                     self.cache).result()
+            except Exception as e:
+                result = {'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e)}
+            if result['status'] == 'ok':
+                self.log('copied from cache' if result['cached'] else 'converted',
+                         filename, '->', result['output'], '({:.2f}s)'.format(result['duration_s']))
+                # from now on the up to date check covers it, even if the .makerbot gets removed
+                with self.lock:
+                    if self.handled.get(filename) == mtime:
+                        del self.handled[filename]
+            else:
+                # stays in handled, so it is only retried once the file changes
+                self.log('failed', filename, result['error'])
+
+    def watch(self):
+        '''Wake the poller on file system events, if watchdog is available'''
+        if watchdog is None:
+            return None
+        wakeup = self.wakeup
+
+        class Handler(watchdog.events.FileSystemEventHandler):
+            def on_any_event(self, event):
+                wakeup.set()
+
+        observer = watchdog.observers.Observer()
+        for folder in self.folders:
+            observer.schedule(Handler(), folder, recursive=self.recursive)
+        observer.start()
+        return observer
+
+    def stop(self, *args):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def run(self):
+        self.log('watching', ', '.join(self.folders), 'with', self.jobs, 'worker(s)',
+                 '(polling)' if watchdog is None else '(watchdog)')
+        observer = self.watch()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            workers = [threading.Thread(target=self.work, args=(pool,), daemon=True) for _ in range(self.jobs)]
+            for worker in workers:
+                worker.start()
+            try:
+                self.poll()
+            except KeyboardInterrupt:
+                self.stop()
+            finally:
+                if observer is not None:
+                    observer.stop()
+                    observer.join()
+                # let the queued files finish, then stop the workers
+                for _ in workers:
+                    self.jobqueue.put(None)
+                for worker in workers:
+                    worker.join()
+        self.log('stopped')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='mbotmake_daemon',
+        description='Convert GCode dropped into watched folders to .Makerbot')
+    parser.add_argument('folders', nargs='+')
+    parser.add_argument('-p', '--printer', default="RepPlus")
+    parser.add_argument('-e', '--extruder', default="SmartExtPlus")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of files converted at the same time')
+    parser.add_argument('-q', '--queue-size', type=int, default=16,
+                        help='files waiting for a worker before the watcher holds off')
+    parser.add_argument('-i', '--interval', type=float, default=2.0,
+                        help='seconds between polls of the folders')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='also watch subdirectories')
+    mbotmake_cache.addCacheArguments(parser)
+    args = parser.parse_args()
+
+    cache = mbotmake_cache.cacheFromArguments(args)
+
+    daemon = ConversionDaemon(args.folders,
+                              mbotmake.parseMachineType(args.printer),
+                              mbotmake.parseExtruderType(args.extruder),
+                              args.jobs, args.queue_size, args.interval, args.recursive, cache)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    daemon.run()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+'''Compare two .makerbot archives by what they print rather than byte by byte.
+
+Both toolpaths are streamed with mbotmake_toolpath and folded into one
+summary per layer: move counts, net extrusion, printed distance, feedrate
+and the bounding box of the printed moves. A layer starts at the first
+extruding move above the layer before it, travel and retracts belong to the
+layer they follow. Memory is bounded by the number of layers, never by the
+number of commands, and the two archives are read on two processes at once.
+The layers are then compared pairwise and so are the fields of meta.json,
+numbers within a tolerance, everything else exactly.
+
+When the toolpaths of both archives have the same CRC and size, they are
+not read at all.
+'''
+
+import argparse
+import collections
+import concurrent.futures
+import fnmatch
+import json
+import math
+import sys
+import zipfile
+
+import mbotmake_toolpath
+from mbotmake_toolpath import Move
+
+# relative and absolute tolerance of numbers, and relative tolerance of move counts
+REL_TOL = 1e-3
+ABS_TOL = 1e-3
+COUNT_TOL = 0.0
+# a printing move this much above the layer starts the next one
+Z_EPSILON = 1e-4
+
+Layer = collections.namedtuple('Layer', ['index', 'z', 'moves', 'extruding_moves', 'extrusion', 'distance',
+                                         'feedrate', 'feedrate_max', 'x_min', 'x_max', 'y_min', 'y_max'])
+# compared with the count tolerance, the other fields but index with the numeric ones
+COUNT_FIELDS = ('moves', 'extruding_moves')
+
+# meta.json fields that differ between any two conversions
+IGNORED_FIELDS = ('uuid',)
+# the value of a meta.json field one of the archives doesn't have
+MISSING = '(missing)'
+
+# where is 'meta.json', 'toolpath' or the layer index
+Difference = collections.namedtuple('Difference', ['where', 'field', 'a', 'b'])
+
+
+def iterLayers(records, commands=None):
+    '''Yield the Layer summaries of the records of a toolpath, commands counts the other records per type'''
+    index = 0
+    layerz = None
+    moves = extruding = 0
+    extrusion = distance = duration = feedratemax = 0.0
+    xmin = ymin = math.inf
+    xmax = ymax = -math.inf
+    px = py = pa = None
+    for record in records:
+        if type(record) is not Move:
+            if commands is not None:
+                commands[type(record).__name__] += 1
+            continue
+        x, y, z, a, feedrate, _ = record
+        if pa is None:
+            px, py, pa = x, y, a
+        if a > pa:
+            if layerz is None:
+                layerz = z
+            elif z > layerz + Z_EPSILON:
+                yield layerSummary(index, layerz, moves, extruding, extrusion, distance, duration, feedratemax,
+                                   xmin, xmax, ymin, ymax)
+                index += 1
+                layerz = z
+                moves = extruding = 0
+                extrusion = distance = duration = feedratemax = 0.0
+                xmin = ymin = math.inf
+                xmax = ymax = -math.inf
+            extruding += 1
+            length = math.hypot(x - px, y - py)
+            distance += length
+            if feedrate > 0.0:
+                duration += length / feedrate
+            if feedrate > feedratemax:
+                feedratemax = feedrate
+            if x < xmin:
+                xmin = x
+            if x > xmax:
+                xmax = x
+            if y < ymin:
+                ymin = y
+            if y > ymax:
+                ymax = y
+        moves += 1
+        extrusion += a - pa
+        px, py, pa = x, y, a
+    if moves:
+        yield layerSummary(index, layerz, moves, extruding, extrusion, distance, duration, feedratemax,
+                           xmin, xmax, ymin, ymax)
+
+
+def layerSummary(index, z, moves, extruding, extrusion, distance, duration, feedratemax, xmin, xmax, ymin, ymax):
+    if not extruding:
+        # nothing printed, so no feedrate or bounding box to speak of
+        return Layer(index, z, moves, 0, extrusion, 0.0, None, None, None, None, None, None)
+    return Layer(index, z, moves, extruding, extrusion, distance, distance / duration if duration else None,
+                 feedratemax, xmin, xmax, ymin, ymax)
+
+
+def readLayers(mbotfile):
+    '''The layers of the toolpath in mbotfile and its commands per record type'''
+    commands = collections.Counter()
+    layers = list(iterLayers(mbotmake_toolpath.readToolpath(mbotfile), commands))
+    commands['Move'] = sum(layer.moves for layer in layers)
+    return layers, dict(commands)
+
+
+def sameToolpath(a, b):
+    '''Whether the toolpath members of the open archives a and b have the same CRC and size'''
+    infoa = a.getinfo(mbotmake_toolpath.TOOLPATH_MEMBER)
+    infob = b.getinfo(mbotmake_toolpath.TOOLPATH_MEMBER)
+    return (infoa.CRC, infoa.file_size) == (infob.CRC, infob.file_size)
+
+
+def flatten(document, prefix=''):
+    '''The leaves of a JSON document by their dotted path, list items as path[index]'''
+    if isinstance(document, dict):
+        for key, value in document.items():
+            yield from flatten(value, '{0}.{1}'.format(prefix, key) if prefix else str(key))
+    elif isinstance(document, list) and document:
+        for index, value in enumerate(document):
+            yield from flatten(value, '{0}[{1}]'.format(prefix, index))
+    else:
+        yield prefix, document
+
+
+def isNumber(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def sameValue(a, b, rel_tol=REL_TOL, abs_tol=ABS_TOL):
+    if isNumber(a) and isNumber(b):
+        return math.isclose(a, b, rel_tol=rel_tol, abs_tol=abs_tol)
+    return a == b
+
+
+def diffMeta(a, b, rel_tol=REL_TOL, abs_tol=ABS_TOL, ignore=IGNORED_FIELDS):
+    '''Yield a Difference for every field of meta.json a and b that differs, a field one lacks is MISSING'''
+    fieldsa = dict(flatten(a))
+    fieldsb = dict(flatten(b))
+    for field in sorted(fieldsa.keys() | fieldsb.keys()):
+        if any(fnmatch.fnmatchcase(field, pattern) for pattern in ignore):
+            continue
+        valuea = fieldsa.get(field, MISSING)
+        valueb = fieldsb.get(field, MISSING)
+        if field not in fieldsa or field not in fieldsb or not sameValue(valuea, valueb, rel_tol, abs_tol):
+            yield Difference('meta.json', field, valuea, valueb)
+
+
+def diffLayers(a, b, rel_tol=REL_TOL, abs_tol=ABS_TOL, count_tol=COUNT_TOL):
+    '''Yield a Difference for every field of the layers a and b that differs, layer by layer'''
+    for layera, layerb in zip(a, b):
+        for field, valuea, valueb in zip(Layer._fields[1:], layera[1:], layerb[1:]):
+            if field in COUNT_FIELDS:
+                same = math.isclose(valuea, valueb, rel_tol=count_tol)
+            else:
+                same = sameValue(valuea, valueb, rel_tol, abs_tol)
+            if not same:
+                yield Difference(layera.index, field, valuea, valueb)
+
+
+def diffMakerbot(filea, fileb, rel_tol=REL_TOL, abs_tol=ABS_TOL, count_tol=COUNT_TOL, ignore=IGNORED_FIELDS,
+                 jobs=2):
+    '''Compare the .makerbot archives filea and fileb, returns a dict of everything that differs'''
+    with zipfile.ZipFile(filea) as archivea, zipfile.ZipFile(fileb) as archiveb:
+        differences = list(diffMeta(mbotmake_toolpath.readMeta(archivea), mbotmake_toolpath.readMeta(archiveb),
+                                    rel_tol, abs_tol, ignore))
+        identical = sameToolpath(archivea, archiveb)
+    result = {'identical_toolpath': identical, 'layers': None, 'commands': None}
+    if not identical:
+        if jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=2) as pool:
+                (layersa, commandsa), (layersb, commandsb) = pool.map(readLayers, (filea, fileb))
+        else:
+            (layersa, commandsa), (layersb, commandsb) = readLayers(filea), readLayers(fileb)
+        result['layers'] = [len(layersa), len(layersb)]
+        result['commands'] = [commandsa, commandsb]
+        for name in sorted(commandsa.keys() | commandsb.keys()):
+            if commandsa.get(name, 0) != commandsb.get(name, 0):
+                differences.append(Difference('toolpath', name + ' commands', commandsa.get(name, 0),
+                                              commandsb.get(name, 0)))
+        if len(layersa) != len(layersb):
+            differences.append(Difference('toolpath', 'layers', len(layersa), len(layersb)))
+        differences.extend(diffLayers(layersa, layersb, rel_tol, abs_tol, count_tol))
+    result['differences'] = [difference._asdict() for difference in differences]
+    return result
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return '{0:.6g}'.format(value)
+    return 'null' if value is None else str(value)
+
+
+def printDiff(filea, fileb, result, maxlayers=20, stream=None):
+    stream = sys.stdout if stream is None else stream
+    print('a:', filea, file=stream)
+    print('b:', fileb, file=stream)
+    if result['identical_toolpath']:
+        print('toolpaths are identical', file=stream)
+    else:
+        print('layers: {0[0]} / {0[1]}'.format(result['layers']), file=stream)
+    shown = set()
+    for difference in result['differences']:
+        where = difference['where']
+        if isinstance(where, int):
+            shown.add(where)
+            if len(shown) > maxlayers:
+                continue
+            where = 'layer {0}'.format(where)
+        print('  {0:<12} {1:<40} {2:>20} {3:>20}'.format(
+            where, difference['field'], formatValue(difference['a']), formatValue(difference['b'])), file=stream)
+    if len(shown) > maxlayers:
+        print('  ... and {0} more layers that differ'.format(len(shown) - maxlayers), file=stream)
+    print(len(result['differences']), 'difference(s)', file=stream)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='mbotmake_diff',
+        description='Compare the toolpaths and meta.json of two .makerbot files')
+    parser.add_argument('a')
+    parser.add_argument('b')
+    parser.add_argument('--rel-tol', type=float, default=REL_TOL,
+                        help='relative tolerance of numbers')
+    parser.add_argument('--abs-tol', type=float, default=ABS_TOL,
+                        help='absolute tolerance of numbers (mm, mm/s, s, ...)')
+    parser.add_argument('--count-tol', type=float, default=COUNT_TOL,
+                        help='relative tolerance of move counts, exact by default')
+    parser.add_argument('--ignore', action='append', default=[], metavar='PATTERN',
+                        help='meta.json fields not to compare besides uuid, e.g. "miracle_config.*", '
+                             'can be given more than once')
+    parser.add_argument('--max-layers', type=int, default=20,
+                        help='number of differing layers to list')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='read both archives at the same time unless 1')
+    parser.add_argument('--json', action='store_true', help='print the differences as JSON')
+    args = parser.parse_args()
+
+    try:
+        result = diffMakerbot(args.a, args.b, args.rel_tol, args.abs_tol, args.count_tol,
+                              IGNORED_FIELDS + tuple(args.ignore), args.jobs)
+    except (mbotmake_toolpath.ToolpathError, zipfile.BadZipFile, KeyError, OSError) as e:
+        print('{0}: {1}'.format(type(e).__name__, e), file=sys.stderr)
+        sys.exit(2)
+    if args.json:
+        json.dump(result, sys.stdout, indent=4)
+        print()
+    else:
+        printDiff(args.a, args.b, result, args.max_layers)
+    # like diff, 1 when the archives differ and 2 when they couldn't be compared
+    sys.exit(1 if result['differences'] else 0)
@@ -71,6 +71,11 @@ class MyFrame2 ( wx.Frame ):
         self.m_button_generate = wx.Button( self, wx.ID_ANY, _(u"Generate .makerbot"), wx.DefaultPosition, wx.DefaultSize, 0 )
         bSizer1.Add( self.m_button_generate, 0, wx.ALL|wx.EXPAND, 5 )
 
+        self.m_button_cancel = wx.Button( self, wx.ID_ANY, _(u"Cancel"), wx.DefaultPosition, wx.DefaultSize, 0 )
+        self.m_button_cancel.Enable( False )
+
+        bSizer1.Add( self.m_button_cancel, 0, wx.ALL|wx.EXPAND, 5 )
+
         self.m_gauge3 = wx.Gauge( self, wx.ID_ANY, 100, wx.DefaultPosition, wx.DefaultSize, wx.GA_HORIZONTAL )
         self.m_gauge3.SetValue( 0 )
         self.m_gauge3.Hide()
@@ -95,6 +100,7 @@ class MyFrame2 ( wx.Frame ):
 
         # Connect Events
         self.m_button_generate.Bind( wx.EVT_BUTTON, self.mbotmake_conv )
+        self.m_button_cancel.Bind( wx.EVT_BUTTON, self.mbotmake_cancel )
 
     def __del__( self ):
         pass
@@ -104,4 +110,7 @@ class MyFrame2 ( wx.Frame ):
     def mbotmake_conv( self, event ):
         event.Skip()
 
+    def mbotmake_cancel( self, event ):
+        event.Skip()
+
 
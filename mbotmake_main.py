@@ -1,13 +1,31 @@
+import threading
+
 import wx
+import wx.lib.newevent
 
 #import the newly created GUI file
 import mbotmake_gui
 import mbotmake
+import mbotmake_cache
+
+# posted by the conversion thread, widgets may only be touched on the event thread
+ProgressEvent, EVT_PROGRESS = wx.lib.newevent.NewEvent()
+DoneEvent, EVT_DONE = wx.lib.newevent.NewEvent()
+
 class MBotFrame(mbotmake_gui.MyFrame2):
    def __init__(self,parent):
       mbotmake_gui.MyFrame2.__init__(self,parent)
+      # pressing generate again for the same file just copies the earlier result
+      self.cache = mbotmake_cache.ConversionCache(mbotmake_cache.defaultCacheDir())
+      self.worker = None
+      self.cancelled = threading.Event()
+      self.Bind(EVT_PROGRESS, self.mbotmake_progress)
+      self.Bind(EVT_DONE, self.mbotmake_done)
+      self.Bind(wx.EVT_CLOSE, self.mbotmake_close)
 
    def mbotmake_conv(self,event):
+      if self.worker is not None:
+         return
       in_file = str(self.m_filePicker_input.GetPath())
       print(in_file)
       slicer = str(self.m_choice_slicer.GetSelection())
@@ -16,11 +34,63 @@ class MBotFrame(mbotmake_gui.MyFrame2):
       print(printer)
       extruder = str(self.m_choice_extruder.GetSelection())
       print(extruder)
-      is_done = mbotmake.main(in_file, printer, extruder, slicer)
-      if is_done:
-            self.m_staticText41.SetLabel("Done!")
+
+      self.cancelled.clear()
+      self.m_button_generate.Disable()
+      self.m_button_cancel.Enable()
+      self.m_gauge3.SetValue(0)
+      self.m_gauge3.Show()
+      self.m_staticText41.SetLabel("Starting...")
+      self.Layout()
+      # converting a big file takes a while, keep the window responsive meanwhile
+      self.worker = threading.Thread(target=self.mbotmake_work, args=(in_file, printer, extruder, slicer), daemon=True)
+      self.worker.start()
+
+   def mbotmake_work(self, in_file, printer, extruder, slicer):
+      '''Runs on the conversion thread'''
+      def progress(status):
+         # once it is done there is nothing left to cancel
+         if self.cancelled.is_set() and status.stage != 'done':
+            raise mbotmake.ConversionCancelled()
+         wx.PostEvent(self, ProgressEvent(status=status))
+
+      is_done = mbotmake.main(in_file, printer, extruder, slicer, cache=self.cache, progress=progress)
+      wx.PostEvent(self, DoneEvent(is_done=is_done))
+
+   def mbotmake_progress(self, event):
+      status = event.status
+      if status.bytes_total:
+         self.m_gauge3.SetValue(int(status.bytes_done * 100 / status.bytes_total))
+      label = "{0}...".format(status.stage.capitalize())
+      if status.eta_s is not None and status.bytes_done < status.bytes_total:
+         label += " {0:.0f}s left".format(status.eta_s)
+      self.m_staticText41.SetLabel(label)
+
+   def mbotmake_cancel(self, event):
+      self.cancelled.set()
+      self.m_button_cancel.Disable()
+      self.m_staticText41.SetLabel("Cancelling...")
+
+   def mbotmake_done(self, event):
+      self.worker.join()
+      self.worker = None
+      self.m_button_generate.Enable()
+      self.m_button_cancel.Disable()
+      self.m_gauge3.Hide()
+      if self.cancelled.is_set():
+         self.m_staticText41.SetLabel("Cancelled")
+      elif event.is_done:
+         self.m_staticText41.SetLabel("Done!")
       else:
          self.m_staticText41.SetLabel("Error, invalid file!")
+      self.Layout()
+
+   def mbotmake_close(self, event):
+      # stop a running conversion, its partial output is removed on the way out
+      if self.worker is not None:
+         self.cancelled.set()
+         self.worker.join()
+      event.Skip()
 
 
 
@@ -28,4 +98,4 @@ app = wx.App(False)
 frame = MBotFrame(None)
 frame.Show(True)
 #start the applications
-app.MainLoop()
\ No newline at end of file
+app.MainLoop()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+'''Serve gcode to .makerbot conversion over HTTP on localhost.
+
+POST the gcode to /convert?printer=RepPlus&extruder=SmartExtPlus and the
+.makerbot comes back as the response. The upload is streamed to a temporary
+file (Content-Length or chunked), converted by convertFile on a pool of warm
+worker processes and streamed back from disk, so no request holds a whole
+gcode or archive in memory. At most jobs conversions run at a time and at
+most queue-size more wait for a worker; requests beyond that are turned
+away with 503 right away instead of piling up. GET /health and /metrics
+report on the service.
+
+Everything runs locally, the server binds to 127.0.0.1 unless told otherwise.
+'''
+
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import mbotmake
+import mbotmake_batch
+import mbotmake_cache
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class RequestError(Exception):
+    '''A request that can't be served, answered with status and the message'''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def readBody(rfile, headers, limit):
+    '''Yield the request body in blocks, from a Content-Length or chunked request'''
+    if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+        total = 0
+        while True:
+            line = rfile.readline(65537)
+            try:
+                size = int(line.split(b';')[0].strip(), 16)
+            except ValueError:
+                raise RequestError(400, 'malformed chunked body')
+            if size == 0:
+                # skip the trailer
+                while rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            total += size
+            if total > limit:
+                raise RequestError(413, 'gcode larger than {0} bytes'.format(limit))
+            yield from readExactly(rfile, size)
+            rfile.readline()
+    else:
+        try:
+            length = int(headers.get('Content-Length', ''))
+        except ValueError:
+            raise RequestError(411, 'Content-Length or chunked transfer encoding required')
+        if length > limit:
+            raise RequestError(413, 'gcode larger than {0} bytes'.format(limit))
+        yield from readExactly(rfile, length)
+
+
+def readExactly(rfile, size):
+    while size:
+        block = rfile.read(min(size, BLOCK_SIZE))
+        if not block:
+            raise RequestError(400, 'request body ended early')
+        size -= len(block)
+        yield block
+
+
+class ConversionService:
+    '''The worker pool, admission limits and counters behind the HTTP handler'''
+
+    def __init__(self, jobs=1, queuesize=16, maxupload=512 * 1024 * 1024, cache=None):
+        self.jobs = jobs
+        self.queuesize = queuesize
+        self.maxupload = maxupload
+        self.cache = cache
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        # a slot is held from the start of the upload to the end of the download
+        self.slots = threading.BoundedSemaphore(jobs + queuesize)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0,
+                         'converted': 0,
+                         'failed': 0,
+                         'busy': 0,
+                         'bad_requests': 0,
+                         'cache_hits': 0,
+                         'cache_misses': 0,
+                         'in_progress': 0,
+                         'bytes_in': 0,
+                         'bytes_out': 0,
+                         'conversion_s': 0.0}
+
+    def count(self, **deltas):
+        with self.lock:
+            for name, delta in deltas.items():
+                self.counters[name] += delta
+
+    def health(self):
+        return {'status': 'ok',
+                'version': mbotmake.VERSION,
+                'jobs': self.jobs,
+                'queue_size': self.queuesize}
+
+    def metrics(self):
+        with self.lock:
+            metrics = dict(self.counters)
+        metrics['uptime_s'] = time.time() - self.started
+        metrics['waiting'] = max(0, metrics['in_progress'] - self.jobs)
+        if self.cache is not None:
+            # the workers count hits and misses on their own copies of the cache,
+            # they are in cache_hits and cache_misses instead
+            cache = self.cache.statistics()
+            del cache['hits'], cache['misses']
+            metrics['cache'] = cache
+        return metrics
+
+    def convert(self, filename, machinetype, extrudertype):
+        '''Convert filename on the pool, returns the mbotmake_batch.convertOne summary'''
+        return self.pool.submit(mbotmake_batch.convertOne, filename, machinetype, extrudertype,
+                                self.cache).result()
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class ConversionHandler(http.server.BaseHTTPRequestHandler):
+    server_version = 'mbotmake/' + mbotmake.VERSION
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        print(time.strftime('%Y-%m-%d %H:%M:%S'), self.address_string(), format % args, file=sys.stderr, flush=True)
+
+    def sendJSON(self, status, document, headers=()):
+        body = json.dumps(document, indent=4).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == '/health':
+            self.sendJSON(200, self.service.health())
+        elif path == '/metrics':
+            self.sendJSON(200, self.service.metrics())
+        else:
+            self.sendJSON(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/convert':
+            self.sendJSON(404, {'error': 'not found'})
+            return
+        service = self.service
+        service.count(requests=1)
+        if not service.slots.acquire(blocking=False):
+            service.count(busy=1)
+            self.sendJSON(503, {'error': 'too many conversions waiting, try again later'}, [('Retry-After', '5')])
+            return
+        service.count(in_progress=1)
+        try:
+            self.convert(urllib.parse.parse_qs(url.query))
+        except RequestError as e:
+            service.count(bad_requests=1)
+            self.sendJSON(e.status, {'error': str(e)})
+        finally:
+            service.count(in_progress=-1)
+            service.slots.release()
+
+    def convert(self, query):
+        service = self.service
+        printer = query.get('printer', ['RepPlus'])[0]
+        extruder = query.get('extruder', ['SmartExtPlus'])[0]
+        # unlike the command line, an unknown name isn't quietly replaced by the default
+        if printer not in mbotmake.PRINTER_NAMES:
+            raise RequestError(400, 'unknown printer {0!r}, one of {1}'.format(
+                printer, ', '.join(mbotmake.PRINTER_NAMES)))
+        if extruder.lstrip('-') not in mbotmake.EXTRUDER_NAMES:
+            raise RequestError(400, 'unknown extruder {0!r}, one of {1}'.format(
+                extruder, ', '.join(mbotmake.EXTRUDER_NAMES)))
+        name = os.path.basename(query.get('name', ['print.gcode'])[0]) or 'print.gcode'
+
+        with tempfile.TemporaryDirectory(prefix='mbotmake-') as directory:
+            filename = os.path.join(directory, 'print.gcode')
+            with open(filename, 'wb') as gcodefile:
+                for block in readBody(self.rfile, self.headers, service.maxupload):
+                    gcodefile.write(block)
+                    service.count(bytes_in=len(block))
+
+            result = service.convert(filename, mbotmake.parseMachineType(printer),
+                                     mbotmake.parseExtruderType(extruder))
+            if result['status'] != 'ok':
+                service.count(failed=1)
+                self.sendJSON(422, {'error': result['error']})
+                return
+            service.count(converted=1, cache_hits=int(result['cached']), cache_misses=int(not result['cached']),
+                          conversion_s=result['duration_s'])
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/zip')
+            self.send_header('Content-Length', str(result['output_bytes']))
+            self.send_header('Content-Disposition', 'attachment; filename="{0}"'.format(
+                os.path.basename(mbotmake.makerbotFilename(name)).replace('"', '')))
+            self.send_header('X-Conversion-Seconds', '{0:.3f}'.format(result['duration_s']))
+            self.end_headers()
+            with open(result['output'], 'rb') as mbotfile:
+                for block in iter(lambda: mbotfile.read(BLOCK_SIZE), b''):
+                    self.wfile.write(block)
+                    service.count(bytes_out=len(block))
+
+
+class ConversionServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        super().__init__(address, ConversionHandler)
+        self.service = service
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='mbotmake_server',
+        description='Serve GCode to .Makerbot conversion over HTTP')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on, localhost only by default')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='number of files converted at the same time')
+    parser.add_argument('-q', '--queue-size', type=int, default=16,
+                        help='requests waiting for a worker before new ones get 503')
+    parser.add_argument('--max-upload', type=int, default=512,
+                        help='largest gcode accepted, in MiB')
+    mbotmake_cache.addCacheArguments(parser)
+    args = parser.parse_args()
+
+    cache = mbotmake_cache.cacheFromArguments(args)
+
+    service = ConversionService(args.jobs, args.queue_size, args.max_upload * 1024 * 1024, cache)
+    server = ConversionServer((args.host, args.port), service)
+    # shutdown() waits for serve_forever, so it can't be called from the signal handler's thread
+    signal.signal(signal.SIGTERM, lambda *args: threading.Thread(target=server.shutdown).start())
+    print('Serving on http://{0}:{1}/ with {2} worker(s)'.format(args.host, args.port, args.jobs),
+          file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''Read the toolpath of a .makerbot archive command by command.
+
+print.jsontoolpath is one JSON array holding every command of the print,
+easily hundreds of MB for a big print. It is decompressed and parsed here a
+block at a time, every command is decoded on its own as soon as it is
+complete, so memory use is bounded by the block size and the longest
+command, not by the toolpath. This does not depend on how the commands are
+laid out over lines, the MakerBot slicer, Simplify3D and mbotmake all write
+them differently.
+
+The commands come out as the typed records below. summarize() works out the
+statistics generateMetajson writes to meta.json from them, which is how the
+meta.json of an existing archive can be audited against its toolpath.
+'''
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import math
+import re
+import sys
+import zipfile
+
+import mbotmake
+
+TOOLPATH_MEMBER = 'print.jsontoolpath'
+META_MEMBER = 'meta.json'
+
+# characters read from the toolpath at a time, and the longest single command
+BLOCK_SIZE = 64 * 1024
+MAX_COMMAND_SIZE = 1024 * 1024
+
+# The commands of a toolpath. Positions are absolute even where the toolpath
+# gave them relative, tags is a tuple of the labels.
+Move = collections.namedtuple('Move', ['x', 'y', 'z', 'a', 'feedrate', 'tags'])
+Comment = collections.namedtuple('Comment', ['comment'])
+ToolheadTemperature = collections.namedtuple('ToolheadTemperature', ['index', 'temperature'])
+FanDuty = collections.namedtuple('FanDuty', ['index', 'value'])
+ToggleFan = collections.namedtuple('ToggleFan', ['index', 'value'])
+# anything else, as found in the toolpath
+Command = collections.namedtuple('Command', ['function', 'parameters', 'metadata', 'tags'])
+
+# The meta.json fields summarize() works out, everything else in meta.json
+# describes the printer and the slicer settings rather than the toolpath.
+AUDITED_FIELDS = ('total_commands', 'duration_s', 'commanded_duration_s', 'num_z_layers', 'num_z_transitions',
+                  'extrusion_distance_mm', 'extrusion_mass_g', 'extruder_temperature', 'bounding_box')
+
+MOVE_TAGS = {label: tag for tag, label in zip(mbotmake.MoveTag, mbotmake.MOVE_TAG_LABELS)}
+
+SEPARATORS = re.compile(r'[\s,\[\]]*')
+# The rest of a move written by mbotmake's ToolpathWriter after MOVE_PREFIX.
+# Almost every command is one of those, matching them directly instead of
+# decoding them to dicts first more than halves the time a toolpath takes.
+MOVE_PARAMETERS = re.compile(r'([-+.\deE]+), "feedrate": ([-+.\deE]+), "x": ([-+.\deE]+), "y": ([-+.\deE]+), '
+                             r'"z": ([-+.\deE]+)\}, "tags": \[(?:"([^"\\]*)")?\]\}\}')
+
+
+class ToolpathError(ValueError):
+    '''The toolpath isn't a JSON array of commands'''
+
+
+def iterRecords(stream, blocksize=BLOCK_SIZE):
+    '''Yield the records of the toolpath read from the text stream'''
+    decode = json.JSONDecoder().raw_decode
+    skip = SEPARATORS.match
+    moveprefix = mbotmake.MOVE_PREFIX
+    parameters = MOVE_PARAMETERS.match
+    buffer = ''
+    position = 0
+    eof = False
+    count = 0
+    previous = None
+    while True:
+        position = skip(buffer, position).end()
+        if position < len(buffer):
+            if buffer.startswith(moveprefix, position):
+                match = parameters(buffer, position + len(moveprefix))
+                if match is not None:
+                    a, feedrate, x, y, z, tag = match.groups()
+                    try:
+                        previous = Move(float(x), float(y), float(z), float(a), float(feedrate),
+                                        () if tag is None else (tag,))
+                    except ValueError:
+                        pass  # not a number after all, leave it to the decoder to complain
+                    else:
+                        position = match.end()
+                        count += 1
+                        yield previous
+                        continue
+            try:
+                document, end = decode(buffer, position)
+            except json.JSONDecodeError as e:
+                # the command may well continue in the next block, a string or number cut
+                # off by the block's end fails anywhere in it, so only the end of the toolpath
+                # or a command that can't be that long any more tell a broken one apart
+                if eof:
+                    raise ToolpathError('malformed command {0}: {1}: {2!r}'.format(
+                        count + 1, e.msg, buffer[position:e.pos + 20][-200:])) from None
+                if len(buffer) - position > MAX_COMMAND_SIZE:
+                    raise ToolpathError('command {0} is malformed or longer than {1} characters: {2}: {3!r}'.format(
+                        count + 1, MAX_COMMAND_SIZE, e.msg, buffer[position:e.pos + 20][:200])) from None
+            else:
+                if not isinstance(document, dict) or not isinstance(document.get('command'), dict):
+                    raise ToolpathError('not a toolpath command: {0!r}'.format(buffer[position:end][:200]))
+                position = end
+                count += 1
+                record = commandRecord(document['command'], previous)
+                if type(record) is Move:
+                    previous = record
+                yield record
+                continue
+        elif eof:
+            return
+        block = stream.read(blocksize)
+        eof = not block
+        buffer = buffer[position:] + block
+        position = 0
+
+
+def commandRecord(command, previous=None):
+    '''The record of a command dict, previous is the Move before it for relative moves'''
+    function = command.get('function')
+    parameters = command.get('parameters', {})
+    if function == 'move':
+        relative = command.get('metadata', {}).get('relative') or {}
+        position = []
+        for key in ('x', 'y', 'z', 'a'):
+            value = float(parameters[key])
+            if relative.get(key) and previous is not None:
+                value += getattr(previous, key)
+            position.append(value)
+        return Move(*position, float(parameters['feedrate']), tuple(command.get('tags', ())))
+    if function == 'comment':
+        return Comment(parameters.get('comment'))
+    if function == 'set_toolhead_temperature':
+        return ToolheadTemperature(parameters.get('index', 0), parameters.get('temperature'))
+    if function == 'fan_duty':
+        return FanDuty(parameters.get('index', 0), parameters.get('value'))
+    if function == 'toggle_fan':
+        return ToggleFan(parameters.get('index', 0), parameters.get('value'))
+    return Command(function, parameters, command.get('metadata', {}), tuple(command.get('tags', ())))
+
+
+def readToolpath(mbotfile, blocksize=BLOCK_SIZE):
+    '''Yield the records of the toolpath in mbotfile, a path, binary stream or zipfile.ZipFile'''
+    with contextOpen(mbotfile) as archive, archive.open(TOOLPATH_MEMBER) as member:
+        yield from iterRecords(io.TextIOWrapper(member, encoding='utf-8'), blocksize)
+
+
+def readMeta(mbotfile):
+    '''The meta.json of mbotfile, a path, binary stream or zipfile.ZipFile'''
+    with contextOpen(mbotfile) as archive:
+        return json.loads(archive.read(META_MEMBER))
+
+
+def contextOpen(mbotfile):
+    '''mbotfile as a ZipFile context, one that was passed in already open is left open'''
+    if isinstance(mbotfile, zipfile.ZipFile):
+        return contextlib.nullcontext(mbotfile)
+    return zipfile.ZipFile(mbotfile)
+
+
+def summarize(records, machinetype=mbotmake.MachineType.REPLICATORPlUS,
+              extrudertype=mbotmake.ExtruderType.SMARTEXTRUDERPLUS):
+    '''The AUDITED_FIELDS of meta.json, worked out from the records of a toolpath.
+
+    The statistics are collected with the ToolpathStats createToolpath uses
+    and turned into meta.json fields by generateMetajson, so for a toolpath
+    mbotmake wrote they match its meta.json but for the first move: the
+    toolpath doesn't say where the print started, so that move takes no
+    time. A move tagged with one of mbotmake's labels keeps its MoveTag,
+    others are tagged by their extrusion the way finishMove does it.
+    '''
+    stats = mbotmake.ToolpathStats(mbotmake.MOTION_LIMITS[machinetype])
+    settings = {'bedtemp': 0, 'extruder_temperature': 0}
+    tags = MOVE_TAGS
+    infill, leaky, retract = mbotmake.MoveTag.INFILL, mbotmake.MoveTag.LEAKY_TRAVEL, mbotmake.MoveTag.RETRACT
+    commands = 0
+    start = previous = None
+    moves = []
+    for record in records:
+        commands += 1
+        if type(record) is Move:
+            x, y, z, a, feedrate, labels = record
+            if previous is None:
+                start = previous = (x, y, z, a)
+            tag = tags.get(labels[0]) if len(labels) == 1 else None
+            if tag is None:
+                pa = previous[3]
+                tag = infill if pa < a else leaky if pa == a else retract
+            # a move that doesn't go anywhere at feedrate 0 (a Long Restart) takes no time
+            moves.append((x, y, z, a, feedrate if feedrate > 0.0 else math.inf, tag))
+            previous = (x, y, z, a)
+            if len(moves) == stats.MOVE_BATCH:
+                stats.addMoves(start, moves)
+                moves = []
+        elif type(record) is ToolheadTemperature and not settings['extruder_temperature']:
+            settings['extruder_temperature'] = record.temperature
+    if start is None:
+        raise ToolpathError('toolpath contains no moves')
+    stats.addMoves(start, moves)
+    stats.addCommand(commands)
+    settings.update(stats.settings())
+    meta = mbotmake.generateMetajson(settings, machinetype, extrudertype)
+    return {field: meta[field] for field in AUDITED_FIELDS}
+
+
+def inspect(mbotfile, machinetype=None, blocksize=BLOCK_SIZE):
+    '''Commands per function, the summary of the toolpath and the same fields from meta.json'''
+    with contextOpen(mbotfile) as archive:
+        try:
+            meta = readMeta(archive)
+        except KeyError:
+            meta = {}
+        if machinetype is None:
+            machinetype = mbotmake.BOT_TYPES.get(meta.get('bot_type'), mbotmake.MachineType.REPLICATORPlUS)
+        functions = collections.Counter()
+
+        def counted(records):
+            for record in records:
+                functions[type(record).__name__ if type(record) is not Command else record.function] += 1
+                yield record
+
+        summary = summarize(counted(readToolpath(archive, blocksize)), machinetype)
+    return {'machine': machinetype.name,
+            'commands': dict(functions),
+            'toolpath': summary,
+            'meta': {field: meta.get(field) for field in AUDITED_FIELDS}}
+
+
+def printInspection(filename, inspection, stream=None):
+    stream = sys.stdout if stream is None else stream
+    print(filename, '({0})'.format(inspection['machine']), file=stream)
+    print('  ' + ', '.join('{0} {1}'.format(count, name) for name, count in inspection['commands'].items()),
+          file=stream)
+    print('  {0:<24} {1:>22} {2:>22}'.format('field', 'toolpath', 'meta.json'), file=stream)
+    for field in AUDITED_FIELDS:
+        toolpath, meta = inspection['toolpath'][field], inspection['meta'][field]
+        if field == 'bounding_box':
+            for key in sorted(toolpath):
+                print('  {0:<24} {1:>22.6g} {2:>22}'.format(
+                    field + '.' + key, toolpath[key], '' if meta is None else '{0:.6g}'.format(meta[key])),
+                    file=stream)
+        else:
+            print('  {0:<24} {1:>22.6g} {2:>22}'.format(
+                field, toolpath, '' if meta is None else '{0:.6g}'.format(meta)), file=stream)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='mbotmake_toolpath',
+        description='Check the meta.json of .makerbot files against their toolpath')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-p', '--printer',
+                        help='printer for the duration estimate, by default the one meta.json names')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    machinetype = None if args.printer is None else mbotmake.parseMachineType(args.printer)
+    results = {}
+    failed = False
+    for filename in args.files:
+        try:
+            results[filename] = inspect(filename, machinetype)
+        except (ToolpathError, zipfile.BadZipFile, KeyError, OSError) as e:
+            results[filename] = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+            failed = True
+            print(filename, results[filename]['error'], file=sys.stderr)
+            continue
+        if not args.json:
+            printInspection(filename, results[filename])
+    if args.json:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+    sys.exit(1 if failed else 0)